@@ -0,0 +1,439 @@
+"""
+Helpers shared by the OSF import commands (import_earth, import_eer)
+"""
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings as django_settings
+from django.db import transaction
+from repository import models as repository_models
+
+# the largest page the OSF API serves
+MAX_PAGE_SIZE = 100
+# related objects OSF returns inside each preprint of a list page, saving a request for each
+EMBEDS = ('contributors', 'license')
+
+# the format of OSF date_modified values, which the API also accepts in filters
+OSF_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+def checkpoint_path(path=None):
+    ''' the JSON file holding the date_modified high-water mark of each provider '''
+    if path:
+        return path
+    return getattr(django_settings, 'OSF_CHECKPOINT_FILE', None) or os.path.join(django_settings.BASE_DIR, 'files', 'osf_checkpoints.json')
+
+def cache_path(path=None):
+    ''' the directory of the OSF response cache '''
+    if path:
+        return path
+    return getattr(django_settings, 'OSF_CACHE_DIR', None) or os.path.join(django_settings.BASE_DIR, 'files', 'osf_cache')
+
+def load_checkpoint(provider, path=None):
+    ''' returns the date_modified the last complete sync of the provider reached, or None '''
+    try:
+        with open(checkpoint_path(path)) as f:
+            return json.load(f).get(provider)
+    except FileNotFoundError:
+        return None
+
+def save_checkpoint(provider, date_modified, path=None):
+    ''' records the provider's high-water mark, replacing the file in one step so a crash cannot truncate it '''
+    path = checkpoint_path(path)
+    try:
+        with open(path) as f:
+            checkpoints = json.load(f)
+    except FileNotFoundError:
+        checkpoints = {}
+    checkpoints[provider] = date_modified
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoints, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def utcnow():
+    ''' the current UTC time in the OSF date format '''
+    return datetime.datetime.utcnow().strftime(OSF_DATE_FORMAT)
+
+def modified_since_url(search_url, since):
+    ''' narrows a preprint search to the preprints modified at or after `since` '''
+    if not since:
+        return search_url
+    return "{}&filter[date_modified][gte]={}".format(search_url, since)
+
+class SyncWindow:
+    '''
+    tracks the date_modified values seen during a sync, to work out the next run's checkpoint
+
+    the checkpoint is the newest date_modified seen, but never later than the start of the run: a
+    preprint modified while the run was walking the pages is then picked up again next time
+    '''
+
+    def __init__(self):
+        self.started = utcnow()
+        self.newest = None
+        self.seen = 0
+
+    def see(self, date_modified):
+        self.seen += 1
+        if date_modified and (self.newest is None or date_modified > self.newest):
+            self.newest = date_modified
+
+    def checkpoint(self):
+        if self.newest is None:
+            return None
+        return min(self.newest, self.started)
+
+def list_url(search_url):
+    ''' asks for the largest pages, with the contributors and license of each preprint embedded '''
+    return search_url + ''.join('&embed={}'.format(embed) for embed in EMBEDS) + '&page[size]={}'.format(MAX_PAGE_SIZE)
+
+def make_session(headers, pool_size):
+    ''' a requests session keeping up to pool_size connections to the OSF API open '''
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def related_href(data, relationship):
+    ''' the related link of one of an OSF object's relationships, '' if it has none '''
+    d = {}
+    return data.get('relationships', d).get(relationship, d).get('links', d).get('related', d).get('href', '')
+
+def embedded(data, relationship):
+    '''
+    returns the embedded copy of a relationship in the shape its related link returns, or None when
+    it is missing or incomplete and has to be fetched
+    '''
+    embed = data.get('embeds', {}).get(relationship)
+    if not embed or 'errors' in embed or embed.get('data') is None:
+        return None
+    items = embed['data']
+    if isinstance(items, list):
+        # only the first page of a list is embedded
+        total = embed.get('links', {}).get('meta', {}).get('total')
+        if total is not None and total > len(items):
+            return None
+        # the importers read each contributor's user, which the embedded copy may leave out
+        if relationship == 'contributors' and not all('users' in item.get('embeds', {}) for item in items):
+            return None
+    return embed
+
+def prefetch_preprint(osf, data, skip=()):
+    '''
+    fetches the sub-resources the importers read for one preprint, returns them by URL
+
+    relationships the list page embedded are taken from the preprint itself. The other requests for
+    one preprint are made in turn, as the files listing leads to the osfstorage listing and that to
+    the versions of the primary file; run it for several preprints at once to overlap them. URLs in
+    skip (licenses already imported) are not fetched
+    '''
+    fetched = {}
+    for relationship in EMBEDS:
+        embed = embedded(data, relationship)
+        if embed is not None:
+            fetched[related_href(data, relationship)] = embed
+
+    def get(url):
+        if len(url) > 10 and url not in skip and url not in fetched:
+            fetched[url] = osf.getData(url)
+        return fetched.get(url)
+
+    get(related_href(data, 'license'))
+    get(related_href(data, 'contributors'))
+    files = get(related_href(data, 'files'))
+    if files and files.get('data'):
+        storage = get(files['data'][0]['relationships']['files']['links']['related']['href'])
+        if storage and storage.get('data'):
+            get(storage['data'][0]['relationships']['versions']['links']['related']['href'])
+    return fetched
+
+def in_order(executor, items, func, window):
+    '''
+    yields (item, future) for func(item) run in executor, in the order of items
+
+    up to window calls are in flight ahead of the item being yielded, so the caller can work on
+    the results one at a time, in order, while later ones are still being fetched
+    '''
+    pending = collections.deque()
+    for item in items:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+class PrefetchedOSF:
+    ''' stands in for OSF while one preprint is saved, answering getData from what prefetch_preprint fetched '''
+
+    def __init__(self, osf, fetched):
+        self.osf = osf
+        self.fetched = fetched
+
+    def getData(self, url):
+        if url in self.fetched:
+            return self.fetched[url]
+        return self.osf.getData(url)
+
+    def download(self, *args, **kwargs):
+        return self.osf.download(*args, **kwargs)
+
+class CacheMiss(Exception):
+    ''' a URL is not in the response cache, in offline mode '''
+
+class ResponseCache:
+    '''
+    an on-disk cache of OSF API responses, one JSON file per URL holding the body and its validators
+
+    the file times double as the LRU order: reading an entry touches it, and once the files take more
+    than max_bytes the least recently used ones are deleted
+    '''
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.name.endswith('.json'))
+
+    def entry_path(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode('UTF-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        ''' returns the cached entry for url, a dict with body, etag, last_modified and stored, or None '''
+        path = self.entry_path(url)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry
+
+    def touch(self, url):
+        try:
+            os.utime(self.entry_path(url))
+        except FileNotFoundError:
+            pass
+
+    def put(self, url, body, etag=None, last_modified=None):
+        path = self.entry_path(url)
+        data = json.dumps({'url': url, 'body': body, 'etag': etag, 'last_modified': last_modified, 'stored': time.time()})
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        with self.lock:
+            try:
+                self.size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        ''' deletes the least recently used entries until the cache is back to 90% of max_bytes, called with lock held '''
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.path) if entry.name.endswith('.json'))
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self.size -= size
+
+class CachedFetcher:
+    '''
+    gets OSF API documents through a ResponseCache
+
+    cached entries are revalidated with If-None-Match / If-Modified-Since, and served as they are
+    when OSF answers 304 or when they were stored less than fresh_for seconds ago. Offline, only the
+    cache is used and a missing URL raises CacheMiss. requests counts the API requests actually sent,
+    revalidations included; file downloads go through Downloader and are not counted
+    '''
+
+    def __init__(self, session, cache=None, offline=False, fresh_for=0):
+        self.session = session
+        self.cache = cache
+        self.offline = offline
+        self.fresh_for = fresh_for
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def send(self, url, headers=None):
+        with self.lock:
+            self.requests += 1
+        return self.session.get(url, headers=headers)
+
+    def get_json(self, url):
+        if self.cache is None:
+            return self.send(url).json()
+
+        entry = self.cache.get(url)
+        if entry is not None and (self.offline or time.time() - entry.get('stored', 0) < self.fresh_for):
+            with self.lock:
+                self.hits += 1
+            return json.loads(entry['body'])
+        if self.offline:
+            raise CacheMiss(url)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        resp = self.send(url, headers)
+        if resp.status_code == 304 and entry is not None:
+            with self.lock:
+                self.hits += 1
+            return json.loads(entry['body'])
+
+        with self.lock:
+            self.misses += 1
+        if resp.status_code == 200:
+            self.cache.put(url, resp.text, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+        return resp.json()
+
+def request_summary(requests, preprints):
+    ''' the "N OSF API requests, X per preprint" line the importers end with '''
+    return "{} OSF API requests, {:.1f} per preprint".format(requests, requests / preprints if preprints else 0)
+
+class DownloadError(Exception):
+    ''' a file could not be downloaded, or did not match the size or hash OSF gave for it '''
+
+def file_matches(path, size=None, hashes=None):
+    ''' True if the file at path has the given size and, where OSF provided one, hash '''
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    algorithm, expected = pick_hash(hashes)
+    return algorithm is None or file_hash(path, algorithm) == expected
+
+def pick_hash(hashes):
+    ''' the strongest (algorithm, hex digest) pair among OSF's hashes, (None, None) if there are none '''
+    for algorithm in ('sha256', 'md5'):
+        if hashes and hashes.get(algorithm):
+            return algorithm, hashes[algorithm].lower()
+    return None, None
+
+def file_hash(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Downloader:
+    '''
+    downloads preprint files in a bounded pool of threads
+
+    a file is written to <path>.part and only renamed to path once its size and hash check out, so
+    path never holds a partial file. A .part left by an interrupted run is resumed with a Range
+    request; if the resumed file then fails the check it is downloaded once more from the start.
+    Files already at path with the right size and hash are not downloaded again. Offline, missing
+    files are reported as failures instead of being fetched
+    '''
+
+    def __init__(self, session, workers=4, offline=False, chunk_size=1024 * 1024):
+        self.session = session
+        self.offline = offline
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        self.lock = threading.Lock()
+        self.downloaded = 0
+        self.skipped = 0
+
+    def submit(self, url, path, size=None, hashes=None):
+        ''' queues a download, returns its future '''
+        future = self.executor.submit(self.download, url, path, size, hashes)
+        self.futures.append((path, future))
+        return future
+
+    def wait(self):
+        ''' waits for every queued download, returns the (path, error) of those that failed '''
+        failures = []
+        for path, future in self.futures:
+            try:
+                future.result()
+            except Exception as error:
+                failures.append((path, error))
+        self.futures = []
+        return failures
+
+    def close(self):
+        self.executor.shutdown()
+
+    def download(self, url, path, size=None, hashes=None):
+        if os.path.exists(path) and file_matches(path, size, hashes):
+            with self.lock:
+                self.skipped += 1
+            return path
+        if self.offline:
+            raise DownloadError('{} is not downloaded, and the import is offline'.format(path))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = path + '.part'
+        resumed = self.fetch(url, part_path)
+        if not file_matches(part_path, size, hashes):
+            os.remove(part_path)
+            if not resumed:
+                raise DownloadError('{} does not match the size or hash OSF gave for it'.format(url))
+            # the part file of the earlier run may have been the bad part
+            self.fetch(url, part_path)
+            if not file_matches(part_path, size, hashes):
+                os.remove(part_path)
+                raise DownloadError('{} does not match the size or hash OSF gave for it'.format(url))
+        os.replace(part_path, path)
+        with self.lock:
+            self.downloaded += 1
+        return path
+
+    def fetch(self, url, part_path):
+        ''' downloads url into part_path, continuing the file if it exists, returns True if it was resumed '''
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        with self.session.get(url, headers=headers, stream=True) as resp:
+            if offset and resp.status_code == 416:
+                # the part file is already complete
+                return True
+            resp.raise_for_status()
+            resumed = offset > 0 and resp.status_code == 206
+            with open(part_path, 'ab' if resumed else 'wb') as f:
+                for chunk in resp.iter_content(self.chunk_size):
+                    f.write(chunk)
+        return resumed
+
+def drop_failed_files(failures):
+    '''
+    deletes the PreprintFile and PreprintVersion rows of the files that did not download, so no
+    preprint points at a missing or corrupt file; the checkpoint is not moved, so the next run
+    downloads them again and recreates the rows. failures are the (path, error) pairs of Downloader.wait
+    '''
+    files_root = os.path.join(django_settings.BASE_DIR, 'files')
+    for path, error in failures:
+        # the importers store the path relative to the files directory
+        repo_path = os.path.relpath(path, files_root)
+        with transaction.atomic():
+            for pf in repository_models.PreprintFile.objects.filter(file=repo_path):
+                # update() rather than save(), this is not an edit of the preprint's metadata
+                repository_models.Preprint.objects.filter(submission_file_id=pf.id).update(submission_file=None)
+                repository_models.PreprintVersion.objects.filter(file_id=pf.id).delete()
+                pf.delete()
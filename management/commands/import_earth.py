@@ -1,16 +1,17 @@
 from django.conf import settings as django_settings
 from django.core.management.base import BaseCommand
-import requests
 import datetime
 import json
-import urllib.request
 import os
 import django.utils.timezone
+from concurrent.futures import ThreadPoolExecutor
+from django.db import transaction
 from submission import models as submission_models
 from repository import models as repository_models
 from core import models as core_models
 from django.template.defaultfilters import slugify
 from uuid import uuid4
+from . import _osf
 
 PRESS_ID = 1
 REPO_ID = 1
@@ -23,7 +24,29 @@ class Command(BaseCommand):
     Pulls data from COS and adds to DB.
     """
 
-    help = "Deletes duplicate settings."
+    help = "Imports eartharxiv preprints from OSF, only those modified since the last complete run unless --full is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full", help="walk every preprint of the provider instead of the ones modified since the last run", action="store_true")
+        parser.add_argument(
+            "--since", help="only import preprints modified at or after this OSF date, e.g. 2020-05-30T00:00:00.000000", type=str, default=None)
+        parser.add_argument(
+            "--checkpoint-file", help="JSON file holding the date_modified reached by the last complete run of each provider", type=str, default=None)
+        parser.add_argument(
+            "--concurrency", help="number of preprints whose OSF sub-resources are fetched at once", type=int, default=8)
+        parser.add_argument(
+            "--cache-dir", help="directory of the OSF response cache, OSF_CACHE_DIR or files/osf_cache if omitted", type=str, default=None)
+        parser.add_argument(
+            "--cache-size", help="size of the OSF response cache in MB, least recently used responses are dropped beyond it", type=int, default=512)
+        parser.add_argument(
+            "--cache-fresh", help="seconds a cached response is used without asking OSF whether it changed", type=int, default=0)
+        parser.add_argument(
+            "--no-cache", help="do not read or write the OSF response cache", action="store_true")
+        parser.add_argument(
+            "--offline", help="only use cached OSF responses, failing on anything not cached", action="store_true")
+        parser.add_argument(
+            "--download-concurrency", help="number of preprint files downloaded at once", type=int, default=4)
 
     def handle(self, *args, **options):
         print("import earth data")
@@ -33,7 +56,41 @@ class Command(BaseCommand):
         print(django_settings.OSF_TOKEN)
         #only do this doi switch once
         #self.switchdoi()
-        w = Worker()
+        since = options['since']
+        if since is None and not options['full']:
+            since = _osf.load_checkpoint(OSF.provider, options['checkpoint_file'])
+        if since:
+            print("importing preprints modified since " + since)
+        else:
+            print("importing all preprints")
+
+        cache = None
+        if not options['no_cache']:
+            cache = _osf.ResponseCache(_osf.cache_path(options['cache_dir']), options['cache_size'] * 1024 * 1024)
+        elif options['offline']:
+            print("--offline needs the cache")
+            return
+        osf = OSF(options['concurrency'], cache, options['offline'], options['cache_fresh'], options['download_concurrency'])
+        w = Worker(_osf.modified_since_url(OSF.earth_search, since), options['concurrency'], osf)
+        if cache is not None:
+            print("{} responses from the cache, {} fetched".format(osf.fetcher.hits, osf.fetcher.misses))
+        print("{} files downloaded, {} already present".format(osf.downloader.downloaded, osf.downloader.skipped))
+        for path, error in w.downloadFailures:
+            print("download failed: {} ... {}".format(path, error))
+
+        # only a run that walked every page moves the checkpoint, an interrupted one is simply repeated,
+        # an offline one only saw what was cached, and failed downloads need the same preprints again
+        checkpoint = w.window.checkpoint()
+        if checkpoint is None:
+            print("no modified preprints")
+        elif options['offline']:
+            print("{} preprints processed from the cache, the checkpoint is unchanged".format(w.window.seen))
+        elif w.downloadFailures:
+            print("{} preprints processed, the checkpoint is unchanged as {} downloads failed".format(w.window.seen, len(w.downloadFailures)))
+        else:
+            _osf.save_checkpoint(OSF.provider, checkpoint, options['checkpoint_file'])
+            print("{} preprints processed, next run starts from {}".format(w.window.seen, checkpoint))
+        print(_osf.request_summary(osf.fetcher.requests, w.window.seen))
 
         
         num = 1
@@ -74,6 +131,7 @@ class Command(BaseCommand):
 class OSF:
     
     url_provides = "https://api.osf.io/v2/preprint_providers"
+    provider = "eartharxiv"
 
     earth_search = "https://api.osf.io/v2/preprints/?filter[provider]=eartharxiv"
     #https://api.osf.io/v2/preprints/?filter[provider]=eartharxiv&filter[date_created][gte]=2020-05-30
@@ -81,20 +139,26 @@ class OSF:
     headers = {'Content-Type': 'application/json',
              'Authorization': 'Bearer {0}'.format(django_settings.OSF_TOKEN)}
 
+    def __init__(self, pool_size=8, cache=None, offline=False, fresh_for=0, download_workers=4):
+        # one keep-alive connection per fetching or downloading thread instead of a new one per request
+        self.session = _osf.make_session(self.headers, pool_size + download_workers)
+        self.fetcher = _osf.CachedFetcher(self.session, cache, offline, fresh_for)
+        self.downloader = _osf.Downloader(self.session, download_workers, offline)
+
     def getProviders(self):
-        resp = requests.get(self.url_provides, headers=self.headers)
+        resp = self.session.get(self.url_provides)
         return resp.text
 
     def getItems(self, url):
         if url is None:
-            resp = requests.get(self.earth_search, headers=self.headers)
-        else:
-            resp = requests.get(url, headers=self.headers)
-        return resp.json()
+            return self.fetcher.get_json(self.earth_search)
+        return self.fetcher.get_json(url)
 
     def getData(self, url):
-        resp = requests.get(url, headers=self.headers)
-        return resp.json()
+        return self.fetcher.get_json(url)
+
+    def download(self, url, path, size=None, hashes=None):
+        return self.downloader.submit(url, path, size, hashes)
 
 ############################################################
 
@@ -356,10 +420,13 @@ class Version:
     pf = None
     pv = None
     oldpath = ''
+    hashes = None
 
-    def __init__(self, data, pp, parentId):
+    def __init__(self, data, pp, parentId, osf, hashes=None):
         print("extract version here")
+        self.osf = osf
         self.extractData(data)
+        self.hashes = hashes or self.hashes
         self.saveFile(pp, parentId)
             
 
@@ -384,10 +451,8 @@ class Version:
 
 
     def downloadFile(self, path, name):
-        if not os.path.exists(path):
-            os.makedirs(path)
-        savepath = os.path.join(path, name)
-        response = urllib.request.urlretrieve(self.downloadLink, savepath)
+        # downloaded in the background, checked against the size and hash from OSF
+        self.osf.download(self.downloadLink, os.path.join(path, name), self.size, self.hashes)
 
     def extractData(self,data):
         self.osfId=data['id']
@@ -397,6 +462,7 @@ class Version:
         
         self.dateCreated = datetime.datetime.strptime(self.dateCreated, self.fi).strftime(self.f)
         self.downloadLink=data['links']['download']
+        self.hashes=(data['attributes'].get('extra') or {}).get('hashes')
 
 
 
@@ -422,13 +488,16 @@ class VersionFiles:
         self.name = data[0]["attributes"]["name"]
         self.downloads = data[0]["attributes"]["extra"]["downloads"]
         self.current_version = str(data[0]["attributes"]["current_version"])
+        # OSF only gives the hashes of the current version
+        self.hashes = data[0]["attributes"]["extra"].get("hashes")
         versions = data[0]["relationships"]["versions"]["links"]["related"]["href"]
-        self.extractVersions(osf.getData(versions), pp)
+        self.extractVersions(osf.getData(versions), pp, osf)
         self.filldownloads(pp)
 
-    def extractVersions(self, data, pp):
+    def extractVersions(self, data, pp, osf):
         for i in range(len(data["data"])):
-            self.arr.append(Version(data["data"][i], pp, self.id))
+            hashes = self.hashes if data["data"][i]["id"] == self.current_version else None
+            self.arr.append(Version(data["data"][i], pp, self.id, osf, hashes))
             if self.arr[i].osfId == self.current_version:
                 print("save submission and version info here")
                 # get the file and version ids from the current version and attach to pp
@@ -446,32 +515,49 @@ class VersionFiles:
 class Worker:
     allLicenses = {}
 
-    osf = OSF()
-    def __init__(self):
+    def __init__(self, url=None, concurrency=8, osf=None):
 
         print("lets get the list of all licenses")
         # create a dictionary of OSF id and License       
-        next = self.osf.earth_search
+        self.osf = osf or OSF(concurrency)
+        self.window = _osf.SyncWindow()
+
+        # the sub-resources of the next preprints are fetched while this one is saved, preprints are still saved in order
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for data, prefetched in _osf.in_order(executor, self.getPreprints(_osf.list_url(url or self.osf.earth_search)), self.prefetch, concurrency * 2):
+                self.window.see(data['attributes'].get('date_modified'))
+                osf = _osf.PrefetchedOSF(self.osf, prefetched.result())
+                # a preprint is saved completely or not at all
+                with transaction.atomic():
+                    a = EarthItem(data)
+                    licId = self.getLicense(a, osf)
+                    pp = self.getArticle(a, licId)
+                    if pp is not None:
+                        self.processArticle(a, pp, osf)
+
+        self.downloadFailures = self.osf.downloader.wait()
+        self.osf.downloader.close()
+        # the file rows were created when the downloads were queued, drop those whose file never arrived
+        _osf.drop_failed_files(self.downloadFailures)
+        self.deleteWithdrawn()
 
+    def getPreprints(self, next):
+        # every page is needed for the date_modified checkpoint to be right
         while next is not None:
             data = self.osf.getItems(next)
-            #next = data['links']['next']
-            next = None
-            for i in range(len(data['data'])):
-                a = EarthItem(data['data'][i])
-                licId = self.getLicense(a)                
-                pp = self.getArticle(a, licId)
-                if pp is not None:
-                    self.processArticle(a, pp)
-
-        self.deleteWithdrawn()
+            next = data['links']['next']
+            for item in data['data']:
+                yield item
 
+    def prefetch(self, data):
+        # runs in the executor, it only talks to OSF
+        return _osf.prefetch_preprint(self.osf, data, skip=self.allLicenses)
 
-    def processArticle(self, a, pp):
-        files = self.getAllVersions(a, pp)
+    def processArticle(self, a, pp, osf):
+        files = self.getAllVersions(a, pp, osf)
         self.getSubjects(a, pp)
         self.getTags(a, pp)
-        auths = self.getAuthors(a, pp)
+        auths = self.getAuthors(a, pp, osf)
         pp.owner_id = auths.owner
         if files is None:
             pp.date_accepted = None
@@ -486,12 +572,12 @@ class Worker:
             obj.delete()
 
 
-    def getLicense(self, a):      
+    def getLicense(self, a, osf):      
         if a.license in self.allLicenses:
             return self.allLicenses[a.license]
 
         if len(a.license) > 10:
-            l = License(self.osf.getData(a.license))
+            l = License(osf.getData(a.license))
             self.allLicenses[a.license] = l.lic.id
             return l.lic.id
 
@@ -514,10 +600,10 @@ class Worker:
                 pp.subject.add(subs.arr[x])
 
     #pass article so that connections can be done here
-    def getAuthors(self, a, pp): 
+    def getAuthors(self, a, pp, osf): 
         print("get authors")
         if len(a.contributors) > 10:
-            return Authors(self.osf.getData(a.contributors),pp)
+            return Authors(osf.getData(a.contributors),pp)
         return None
 
     def getPrimaryFile(self, a, pp): 
@@ -531,10 +617,10 @@ class Worker:
         pp = Article(a, licId)
         return pp.pp
 
-    def getAllVersions(self, a, pp):
+    def getAllVersions(self, a, pp, osf):
         print("get all versions")
         if len(a.files) > 10:
-            return VersionFiles(self.osf.getData(a.files), self.osf, pp)
+            return VersionFiles(osf.getData(a.files), osf, pp)
         return None
 
 
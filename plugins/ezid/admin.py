@@ -5,3 +5,30 @@ class RepoEZIDSettingsAdmin(admin.ModelAdmin):
     pass
 
 admin.site.register(RepoEZIDSettings, RepoEZIDSettingsAdmin)
+
+class EZIDJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'preprint', 'action', 'status', 'attempts', 'next_attempt', 'date_updated')
+    list_filter = ('action', 'status')
+    raw_id_fields = ('preprint',)
+
+admin.site.register(EZIDJob, EZIDJobAdmin)
+
+class EZIDPayloadFingerprintAdmin(admin.ModelAdmin):
+    list_display = ('doi', 'fingerprint', 'date_deposited')
+    search_fields = ('doi',)
+
+admin.site.register(EZIDPayloadFingerprint, EZIDPayloadFingerprintAdmin)
+
+class EZIDReservedDOIAdmin(admin.ModelAdmin):
+    list_display = ('doi', 'ezid_settings', 'preprint', 'date_reserved', 'date_claimed')
+    list_filter = ('ezid_settings',)
+    raw_id_fields = ('preprint',)
+
+admin.site.register(EZIDReservedDOI, EZIDReservedDOIAdmin)
+
+class EZIDOutboxAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'action', 'preprint', 'article', 'resolved', 'replays', 'date_created', 'date_replayed')
+    list_filter = ('action', 'resolved')
+    raw_id_fields = ('preprint', 'article')
+
+admin.site.register(EZIDOutbox, EZIDOutboxAdmin)
@@ -0,0 +1,241 @@
+"""
+This module contains asyncio counterparts of the EZID plugin's deposit functions, for large re-deposits
+
+mint_doi_via_ezid, update_doi_via_ezid and create_doi_via_ezid take the same arguments as
+their logic.py namesakes and return the same "success: ..." / "error: ..." strings, but must be
+awaited inside run_concurrently, which runs them on one event loop with a connection limited
+aiohttp session per EZID endpoint. Database work never runs on the loop: the task generator and
+the result callback are called a batch at a time on one dedicated thread, which closes its database
+connection when the run ends.
+
+Needs aiohttp (pip install aiohttp), which is imported on first use.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import asyncio
+import contextvars
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from . import client, metrics, preflight
+from . import logic
+
+# the clients of the run_concurrently call in progress
+_clients = contextvars.ContextVar('ezid_async_clients')
+
+def require_aiohttp():
+    ''' imports aiohttp, with installation instructions if it is missing '''
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError('The asynchronous EZID client needs aiohttp, install it with `pip install aiohttp`.')
+    return aiohttp
+
+class AsyncRateLimiter:
+    ''' Spaces out calls on one event loop so no more than `rate` happen per second '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = time.monotonic()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class AsyncEZIDClient:
+    ''' The asyncio counterpart of client.EZIDClient: same errors, retries and circuit breaker '''
+
+    def __init__(self, username, password, endpoint_url, concurrency, timeout=client.DEFAULT_TIMEOUT,
+                 retries=client.DEFAULT_RETRIES, retry_backoff=client.DEFAULT_RETRY_BACKOFF,
+                 breaker_threshold=client.DEFAULT_BREAKER_THRESHOLD, breaker_reset=client.DEFAULT_BREAKER_RESET):
+        aiohttp = require_aiohttp()
+        self.aiohttp = aiohttp
+        self.endpoint_url = endpoint_url.rstrip('/')
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.breaker = client.CircuitBreaker(breaker_threshold, breaker_reset)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            auth=aiohttp.BasicAuth(username, password),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers={'Content-Type': 'text/plain; charset=UTF-8'},
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def request(self, method, path, data=None, idempotent=True):
+        ''' see client.EZIDClient.request '''
+        self.breaker.before_request()
+        try:
+            response = await self._request_with_retries(method, path, data, idempotent)
+        except client.EZIDClientError:
+            self.breaker.record_success()
+            raise
+        except BaseException:
+            # cancellation included, it ends a half open trial too
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return response
+
+    async def _request_with_retries(self, method, path, data, idempotent):
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    status, reason, body = await self._request_once(method, path, data)
+            except self.aiohttp.ClientConnectorError as error:
+                failure, sent = client.EZIDTransportError('connection failed: {}'.format(error)), False
+            except (self.aiohttp.ClientError, asyncio.TimeoutError, OSError) as error:
+                failure, sent = client.EZIDTransportError('{}: {}'.format(type(error).__name__, error)), True
+            else:
+                if status < 500:
+                    if status >= 400:
+                        raise client.EZIDClientError('{} {}'.format(status, reason), status, body)
+                    return status, reason, body
+                failure, sent = client.EZIDServerError('{} {}'.format(status, reason), status, body), status != 503
+
+            if attempt >= self.retries or (sent and not idempotent):
+                raise failure
+            attempt += 1
+            await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    async def _request_once(self, method, path, data):
+        url = '{}/{}'.format(self.endpoint_url, path)
+        body = data.encode('UTF-8') if data is not None else None
+        async with self.session.request(method, url, data=body) as response:
+            return response.status, response.reason, await response.text(encoding='UTF-8')
+
+def get_async_client(ezid_config):
+    ''' returns the client of the current run_concurrently call for ezid_config's endpoint and credentials '''
+    clients = _clients.get()
+    key = (ezid_config['endpoint_url'].rstrip('/'), ezid_config['username'], ezid_config['password'])
+    if key not in clients['clients']:
+        clients['clients'][key] = AsyncEZIDClient(
+            ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'], clients['concurrency'],
+            timeout=getattr(settings, 'EZID_TIMEOUT', client.DEFAULT_TIMEOUT),
+            retries=getattr(settings, 'EZID_RETRIES', client.DEFAULT_RETRIES),
+            retry_backoff=getattr(settings, 'EZID_RETRY_BACKOFF', client.DEFAULT_RETRY_BACKOFF),
+            breaker_threshold=getattr(settings, 'EZID_BREAKER_THRESHOLD', client.DEFAULT_BREAKER_THRESHOLD),
+            breaker_reset=getattr(settings, 'EZID_BREAKER_RESET', client.DEFAULT_BREAKER_RESET),
+        )
+    return clients['clients'][key]
+
+async def send_ezid_request(action, ezid_config, method, path, payload, idempotent=True):
+    ''' the asyncio counterpart of logic.send_ezid_request '''
+    ezid_client = get_async_client(ezid_config)
+    try:
+        with metrics.timer(metrics.PHASE_HTTP):
+            status, reason, response = await ezid_client.request(method, path, payload, idempotent=idempotent)
+    except (client.EZIDTransportError, client.EZIDCircuitOpenError) as ezid_error:
+        metrics.count(action, metrics.OUTCOME_TRANSPORT_ERROR)
+        logic.logger.error('EZID {} request failed ({}): {}'.format(action, type(ezid_error).__name__, ezid_error.as_result()))
+        return ezid_error.as_result()
+    except client.EZIDError as ezid_error:
+        metrics.count(action, metrics.OUTCOME_EZID_ERROR)
+        logic.logger.error('EZID {} request failed ({}): {}'.format(action, type(ezid_error).__name__, ezid_error.as_result()))
+        return ezid_error.as_result()
+    metrics.count(action, metrics.OUTCOME_SUCCESS)
+    return response
+
+async def mint_doi_via_ezid(ezid_config, ezid_metadata, template):
+    ''' see logic.mint_doi_via_ezid '''
+    ezid_metadata['now'] = timezone.now()
+    logic.validate_published_doi(ezid_metadata)
+    try:
+        payload = logic.build_ezid_payload(ezid_config, ezid_metadata, template, check_schema=preflight.is_enabled())
+    except preflight.PreflightError as error:
+        return error.as_result()
+    return await send_ezid_request('mint', ezid_config, 'POST', 'shoulder/' + client.encode(ezid_config['shoulder']), payload, idempotent=False)
+
+async def update_doi_via_ezid(ezid_config, ezid_metadata, template, status=None):
+    ''' see logic.update_doi_via_ezid '''
+    ezid_metadata['now'] = timezone.now()
+    logic.validate_published_doi(ezid_metadata)
+    try:
+        payload = logic.build_ezid_payload(ezid_config, ezid_metadata, template, status=status, check_schema=preflight.is_enabled())
+    except preflight.PreflightError as error:
+        return error.as_result()
+    return await send_ezid_request('update', ezid_config, 'POST', 'id/doi:' + client.encode(ezid_metadata['update_id']), payload)
+
+async def create_doi_via_ezid(ezid_config, ezid_metadata, template):
+    ''' see logic.create_doi_via_ezid '''
+    ezid_metadata['now'] = timezone.now()
+    try:
+        payload = logic.build_ezid_payload(ezid_config, ezid_metadata, template, check_schema=preflight.is_enabled())
+    except preflight.PreflightError as error:
+        return error.as_result()
+    return await send_ezid_request('create', ezid_config, 'PUT', 'id/doi:' + client.encode(ezid_metadata['doi']), payload)
+
+def run_concurrently(tasks, func, on_result, concurrency=16, rate=None, batch_size=None):
+    '''
+    the asyncio counterpart of bulk.run_concurrently, func is one of this module's coroutine functions
+
+    tasks is consumed, and on_result(key, result, error) called, in batches on a single thread of
+    their own, so both may use the ORM without blocking the loop; the next batch of tasks is gathered
+    while the current one is being sent
+    '''
+    require_aiohttp()
+
+    batch_size = batch_size or concurrency * 4
+    limiter = AsyncRateLimiter(rate)
+
+    def next_batch():
+        return list(islice(tasks, batch_size))
+
+    def handle_results(results):
+        for key, result, error in results:
+            on_result(key, result, error)
+
+    async def call(key, args):
+        await limiter.wait()
+        try:
+            return key, await func(*args), None
+        except Exception as error:
+            return key, None, error
+
+    async def run(orm_thread):
+        clients = {'concurrency': concurrency, 'clients': {}}
+        _clients.set(clients)
+        loop = asyncio.get_running_loop()
+
+        def fetch():
+            return loop.run_in_executor(orm_thread, next_batch)
+
+        def handle(results):
+            return loop.run_in_executor(orm_thread, handle_results, results)
+
+        try:
+            batch = await fetch()
+            while batch:
+                upcoming = asyncio.ensure_future(fetch())
+                results = await asyncio.gather(*(call(key, args) for key, args in batch))
+                await handle(results)
+                batch = await upcoming
+        finally:
+            for ezid_client in clients['clients'].values():
+                await ezid_client.close()
+
+    # one thread, so the generator and the callback never run at the same time and share one connection
+    orm_thread = ThreadPoolExecutor(max_workers=1)
+    try:
+        asyncio.run(run(orm_thread))
+    finally:
+        orm_thread.submit(connection.close).result()
+        orm_thread.shutdown()
@@ -0,0 +1,108 @@
+"""
+This module contains helpers shared by the EZID plugin's bulk management commands
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+class RateLimiter:
+    ''' Spaces out calls from any number of threads so no more than `rate` happen per second '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def stream_queryset_batches(queryset, batch_size=500):
+    ''' yields lists of objects from a queryset in primary key order, one query (plus prefetches) per batch '''
+    # keyset slicing rather than .iterator(), which would ignore prefetch_related; it keeps memory flat and
+    # lets callers save objects (and so change the filtered set) as they go
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+def stream_queryset(queryset, batch_size=500):
+    ''' yields the objects of a queryset in primary key order, one batch per query '''
+    for batch in stream_queryset_batches(queryset, batch_size):
+        for obj in batch:
+            yield obj
+
+class Progress:
+    ''' Writes a progress line with rate and ETA at most every `every` seconds '''
+
+    def __init__(self, total, write, every=5.0):
+        self.total = total
+        self.write = write
+        self.every = every
+        self.done = 0
+        self.start = self.last_report = time.monotonic()
+
+    def step(self, count=1):
+        self.done += count
+        now = time.monotonic()
+        if now - self.last_report >= self.every or self.done == self.total:
+            self.last_report = now
+            self.write(self.status(now))
+
+    def status(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        rate = self.done / elapsed if elapsed else 0
+        remaining = (self.total - self.done) / rate if rate else 0
+        return '{}/{} ({:.1f}/sec, ETA {})'.format(self.done, self.total, rate, format_duration(remaining))
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+def run_concurrently(tasks, func, on_result, concurrency=4, rate=None):
+    '''
+    calls func(*args) for every (key, args) in tasks on a bounded thread pool
+
+    on_result(key, result, error) is called in the calling thread as each call finishes, so it is
+    safe to use the ORM there; tasks is consumed lazily, keeping at most 2 * concurrency in flight
+    '''
+    limiter = RateLimiter(rate)
+
+    def call(args):
+        limiter.wait()
+        return func(*args)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+
+        def drain(return_when):
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                key = in_flight.pop(future)
+                error = future.exception()
+                on_result(key, None if error else future.result(), error)
+
+        for key, args in tasks:
+            in_flight[executor.submit(call, args)] = key
+            if len(in_flight) >= concurrency * 2:
+                drain(FIRST_COMPLETED)
+
+        if in_flight:
+            drain(ALL_COMPLETED)
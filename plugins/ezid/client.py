@@ -0,0 +1,321 @@
+"""
+This module contains a pooled, keep-alive HTTP client for the EZID API
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import base64
+import http.client
+import queue
+import random
+import select
+import threading
+import time
+from urllib.parse import quote, unquote, urlsplit
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 60
+
+# errors raised when a pooled connection was closed by the server between requests
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError)
+
+class EZIDError(Exception):
+    ''' Base class for failed EZID requests '''
+    retryable = False
+
+    def __init__(self, message, status=None, body=''):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+
+    def as_result(self):
+        ''' returns the error in the same "error: ..." form EZID uses in its response bodies '''
+        if self.body.startswith('error:'):
+            return self.body.strip()
+        return 'error: {}'.format(self)
+
+class EZIDClientError(EZIDError):
+    ''' EZID rejected the request (4xx), sending it again will not help '''
+
+class EZIDServerError(EZIDError):
+    ''' EZID failed to handle the request (5xx) '''
+    retryable = True
+
+class EZIDTransportError(EZIDError):
+    ''' the request did not get a response: connection refused or reset, timeout, ... '''
+    retryable = True
+
+class EZIDCircuitOpenError(EZIDError):
+    ''' the request was not sent because EZID has been failing '''
+
+class CircuitBreaker:
+    '''
+    Stops requests for `reset_timeout` seconds after `failure_threshold` consecutive failed requests
+
+    a request counts once, however many retries it took. Once the timeout is over the circuit is half
+    open: a single trial request goes through while the others are still refused, and its outcome
+    closes the circuit or opens it again
+    '''
+
+    def __init__(self, failure_threshold=DEFAULT_BREAKER_THRESHOLD, reset_timeout=DEFAULT_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.half_open = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None and (self.half_open or time.monotonic() - self.opened_at < self.reset_timeout)
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.half_open:
+                raise EZIDCircuitOpenError('EZID circuit half open, waiting for the trial request')
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise EZIDCircuitOpenError('EZID circuit open after {} consecutive failures'.format(self.failures))
+            # let this request through as the trial
+            self.half_open = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.half_open = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.half_open or self.failures >= self.failure_threshold:
+                # a failed trial opens the circuit again right away
+                self.opened_at = time.monotonic()
+                self.half_open = False
+
+class EZIDClient:
+    ''' Sends requests to one EZID endpoint with one set of credentials, reusing connections '''
+
+    def __init__(self, username, password, endpoint_url, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, retry_backoff=DEFAULT_RETRY_BACKOFF,
+                 breaker_threshold=DEFAULT_BREAKER_THRESHOLD, breaker_reset=DEFAULT_BREAKER_RESET):
+        self.endpoint_url = endpoint_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+
+        parts = urlsplit(self.endpoint_url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path
+
+        # send the credentials up front, rather than waiting for a 401 challenge on every request
+        credentials = '{}:{}'.format(username, password).encode('UTF-8')
+        self.auth_header = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _get_connection(self):
+        ''' returns an idle pooled connection (flagged as reused), or a new one '''
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    @staticmethod
+    def _is_dropped(connection):
+        ''' True if the server has closed an idle connection, an idle socket that is readable is at EOF '''
+        if connection.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _release_connection(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def ensure_pool_size(self, pool_size):
+        ''' grows the pool so it can keep `pool_size` idle connections, e.g. one per worker thread '''
+        if pool_size > self.pool_size:
+            with self._pool.mutex:
+                self._pool.maxsize = pool_size
+            self.pool_size = pool_size
+
+    def close(self):
+        ''' closes every idle connection in the pool '''
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def request(self, method, path, data=None, idempotent=True):
+        '''
+        sends a request to the endpoint, returns a (status, reason, body) tuple for 2xx responses
+
+        raises an EZIDError subclass otherwise; 5xx responses and transport errors are retried with
+        jittered exponential backoff, but for non idempotent requests (minting) only when EZID cannot
+        have acted on the request, so a retry never mints a second DOI. The circuit breaker counts the
+        request once, when it has succeeded or its retries are used up
+        '''
+        self.breaker.before_request()
+        try:
+            response = self._request_with_retries(method, path, data, idempotent)
+        except EZIDClientError:
+            # EZID answered, so it is healthy even if it did not like this request
+            self.breaker.record_success()
+            raise
+        except BaseException:
+            # anything else, even an interruption, ends a half open trial
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return response
+
+    def _request_with_retries(self, method, path, data, idempotent):
+        attempt = 0
+        while True:
+            try:
+                status, reason, body = self._request_once(method, path, data, idempotent)
+            except ConnectionRefusedError as error:
+                failure, sent = EZIDTransportError('connection refused: {}'.format(error)), False
+            except (OSError, http.client.HTTPException) as error:
+                failure, sent = EZIDTransportError('{}: {}'.format(type(error).__name__, error)), True
+            else:
+                if status < 500:
+                    if status >= 400:
+                        raise EZIDClientError('{} {}'.format(status, reason), status, body)
+                    return status, reason, body
+                failure, sent = EZIDServerError('{} {}'.format(status, reason), status, body), status != 503
+
+            if attempt >= self.retries or (sent and not idempotent):
+                raise failure
+            attempt += 1
+            time.sleep(self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    def _request_once(self, method, path, data, idempotent=True):
+        body = data.encode('UTF-8') if data is not None else None
+        headers = {'Authorization': self.auth_header,
+                   'Content-Type': 'text/plain; charset=UTF-8',
+                   'Connection': 'keep-alive'}
+        url = '{}/{}'.format(self.base_path, path)
+
+        connection, reused = self._get_connection()
+        if reused and not idempotent and self._is_dropped(connection):
+            # a request that must not be repeated only goes out on a connection known to be open
+            connection.close()
+            connection, reused = self._new_connection(), False
+        try:
+            try:
+                response = self._send(connection, method, url, body, headers)
+            except STALE_CONNECTION_ERRORS:
+                # the server may have dropped an idle connection, but it may also have received the
+                # request and failed while answering, so only requests that are safe to repeat are sent again
+                if not reused or not idempotent:
+                    raise
+                # try once more on a fresh one
+                connection.close()
+                connection = self._new_connection()
+                response = self._send(connection, method, url, body, headers)
+        except Exception:
+            connection.close()
+            raise
+
+        status, reason, response_body, will_close = response
+        if will_close:
+            connection.close()
+        else:
+            self._release_connection(connection)
+
+        return status, reason, response_body.decode('UTF-8')
+
+    @staticmethod
+    def _send(connection, method, url, body, headers):
+        connection.request(method, url, body=body, headers=headers)
+        response = connection.getresponse()
+        # the body must be read completely before the connection can be reused
+        response_body = response.read()
+        return response.status, response.reason, response_body, response.will_close
+
+    def mint(self, shoulder, data):
+        ''' mints a new identifier on the given shoulder '''
+        return self.request('POST', 'shoulder/' + encode(shoulder), data, idempotent=False)
+
+    def create(self, identifier, data):
+        ''' creates the given identifier '''
+        return self.request('PUT', 'id/doi:' + encode(identifier), data)
+
+    def update(self, identifier, data):
+        ''' updates the metadata of the given identifier '''
+        return self.request('POST', 'id/doi:' + encode(identifier), data)
+
+    def get(self, identifier):
+        ''' fetches the metadata of the given identifier, the body is "success: doi:..." followed by ANVL lines '''
+        return self.request('GET', 'id/doi:' + encode(identifier))
+
+    def is_up(self):
+        ''' asks EZID whether it is up, without retries; a healthy answer closes the circuit '''
+        try:
+            status, reason, body = self._request_once('GET', 'status', None)
+        except (OSError, http.client.HTTPException):
+            return False
+        if status == 200 and body.startswith('success:'):
+            self.breaker.record_success()
+            return True
+        return False
+
+def encode(txt):
+    ''' encode a text string '''
+    return quote(txt, ':/')
+
+def parse_anvl(text):
+    ''' parses ANVL "key: value" lines into a dict, undoing EZID's percent escaping of %, newlines and colons '''
+    metadata = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        key, _, value = line.partition(':')
+        metadata[unquote(key.strip())] = unquote(value.strip())
+    return metadata
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(username, password, endpoint_url, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, **options):
+    '''
+    returns the shared client for an endpoint and credential set, creating it on first use
+
+    options (retries, retry_backoff, breaker_threshold, breaker_reset) are used when the client is created
+    '''
+    key = (endpoint_url.rstrip('/'), username, password)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None or client.timeout != timeout:
+            if client is not None:
+                client.close()
+            client = EZIDClient(username, password, endpoint_url, pool_size=pool_size, timeout=timeout, **options)
+            _clients[key] = client
+        else:
+            client.ensure_pool_size(pool_size)
+    return client
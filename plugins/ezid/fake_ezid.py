@@ -0,0 +1,227 @@
+"""
+This module contains a local stand-in for the EZID API, for benchmarks and tests
+
+It has no Django dependencies, so it can be started from pytest as well as from the
+run_fake_ezid and benchmark_ezid management commands:
+
+    with FakeEZIDServer(latency=0.05) as server:
+        ezid_config = server.ezid_config()
+        ...
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import base64
+import itertools
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import quote, unquote
+
+from .client import parse_anvl
+
+USERNAME = 'fake'
+PASSWORD = 'fake'
+SHOULDER = 'doi:10.5072/FK2'
+
+def format_anvl(metadata):
+    ''' formats a dict as an ANVL body, escaping the characters EZID escapes '''
+    return '\n'.join('{}: {}'.format(quote(key, safe=' _.-/'), value.replace('%', '%25').replace('\n', '%0A').replace('\r', '%0D'))
+                     for key, value in metadata.items())
+
+class FakeEZIDHandler(BaseHTTPRequestHandler):
+    ''' answers mint, create, update, view and status requests the way EZID does '''
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let Nagle hold back the body on a kept-alive socket
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_ezid_request('GET')
+
+    def do_POST(self):
+        self.handle_ezid_request('POST')
+
+    def do_PUT(self):
+        self.handle_ezid_request('PUT')
+
+    def handle_ezid_request(self, method):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('UTF-8')
+        path = unquote(self.path.lstrip('/'))
+
+        if path == 'status':
+            self.respond(200, 'success: EZID is up')
+            return
+
+        if self.headers.get('Authorization') != fake.auth_header:
+            # same challenge EZID sends, urllib's HTTPBasicAuthHandler waits for it before sending credentials
+            self.respond(401, 'error: unauthorized', {'WWW-Authenticate': 'Basic realm="EZID"'})
+            return
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        injected = fake.next_error()
+        if injected:
+            self.respond(injected, 'error: injected failure')
+            return
+
+        status, response = fake.handle(method, path, parse_anvl(body))
+        self.respond(status, response)
+
+    def respond(self, status, text, headers=None):
+        body = text.encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    fake = None
+
+class FakeEZIDServer:
+    '''
+    An in-memory EZID on a local port
+
+    latency: seconds to wait before answering each authenticated request
+    error_rate: fraction of authenticated requests answered with error_status instead
+    fail_next(count, status): answer the next `count` requests with `status`
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, username=USERNAME, password=PASSWORD,
+                 shoulder=SHOULDER, latency=0, error_rate=0, error_status=500):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.shoulder = shoulder
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.auth_header = 'Basic ' + base64.b64encode('{}:{}'.format(username, password).encode('UTF-8')).decode('ascii')
+
+        self.identifiers = {}
+        self.requests = 0
+        self._counter = itertools.count(1)
+        self._forced_errors = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def ezid_config(self, owner='fake-owner'):
+        ''' returns an ezid_config dictionary pointing at this server '''
+        return {'shoulder': self.shoulder,
+                'username': self.username,
+                'password': self.password,
+                'endpoint_url': self.endpoint_url,
+                'owner': owner}
+
+    def _bind(self):
+        self._server = _ThreadingHTTPServer((self.host, self.port), FakeEZIDHandler)
+        self._server.fake = self
+        # port 0 picks a free port
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        ''' serves requests from a background thread '''
+        self._bind()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        ''' runs the server in the calling thread, until interrupted '''
+        self._bind()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset(self):
+        ''' forgets every identifier and pending injected error '''
+        with self._lock:
+            self.identifiers.clear()
+            self.requests = 0
+            self._forced_errors = []
+
+    def fail_next(self, count=1, status=500):
+        with self._lock:
+            self._forced_errors.extend([status] * count)
+
+    def next_error(self):
+        ''' returns the status of the injected error for this request, or None '''
+        with self._lock:
+            self.requests += 1
+            if self._forced_errors:
+                return self._forced_errors.pop(0)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status
+        return None
+
+    def handle(self, method, path, metadata):
+        ''' applies a request to the store, returns (status, response body) '''
+        if method == 'POST' and path.startswith('shoulder/'):
+            shoulder = path[len('shoulder/'):]
+            with self._lock:
+                identifier = '{}{:06d}'.format(shoulder, next(self._counter))
+                self.identifiers[identifier] = self.with_defaults(metadata)
+            return 201, 'success: {}'.format(identifier)
+
+        if not path.startswith('id/'):
+            return 400, 'error: bad request - unrecognized request'
+        identifier = path[len('id/'):]
+
+        with self._lock:
+            existing = self.identifiers.get(identifier)
+            if method == 'GET':
+                if existing is None:
+                    return 400, 'error: bad request - no such identifier'
+                return 200, 'success: {}\n{}'.format(identifier, format_anvl(existing))
+            if method == 'PUT':
+                if existing is not None:
+                    return 400, 'error: bad request - identifier already exists'
+                self.identifiers[identifier] = self.with_defaults(metadata)
+                return 201, 'success: {}'.format(identifier)
+            if method == 'POST':
+                if existing is None:
+                    return 400, 'error: bad request - no such identifier'
+                if existing.get('_status') == 'public' and metadata.get('_status') == 'reserved':
+                    return 400, 'error: bad request - invalid status transition'
+                existing.update(metadata)
+                return 200, 'success: {}'.format(identifier)
+        return 405, 'error: method not allowed'
+
+    def with_defaults(self, metadata):
+        metadata = dict(metadata)
+        metadata.setdefault('_status', 'public')
+        metadata['_owner'] = metadata.get('_owner') or self.username
+        metadata['_created'] = str(int(time.time()))
+        return metadata
@@ -7,25 +7,66 @@ __author__ = "Hardy Pottinger & Mahjabeen Yucekul"
 __license__ = "BSD 3-Clause"
 __maintainer__ = "California Digital Library"
 
+import hashlib
+import random
 import re
-from urllib.parse import quote
-import urllib.request as urlreq
-import json
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone as dt_timezone
+from urllib.parse import unquote
+from xml.etree import ElementTree
 # import pdb # use for debugging
 from django.core.validators import URLValidator, ValidationError
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Min, Prefetch, Q, Sum, When, prefetch_related_objects
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
-from django.template.loader import render_to_string
+from django.template.loader import get_template
 from utils.logger import get_logger
 from utils import setting_handler
+from core.models import SettingValue
+from journal import models as journal_models
+from press import models as press_models
+from repository.models import Preprint, PreprintAuthor
 
-from .models import RepoEZIDSettings
+from . import bulk, client, metrics, preflight, registry
+from .models import EZIDJob, EZIDOutbox, EZIDPayloadFingerprint, EZIDReservedDOI
 
 logger = get_logger(__name__)
 
-USERNAME = settings.EZID_USERNAME
-PASSWORD = settings.EZID_PASSWORD
-ENDPOINT_URL = settings.EZID_ENDPOINT_URL
+
+# outcomes of update_doi_if_changed
+UPDATE_SKIPPED = 'skipped'
+UPDATE_CHANGED = 'changed'
+UPDATE_SENT = 'sent'
+
+# Crossref settings read for every journal deposit, cached per journal
+JOURNAL_IDENTIFIER_SETTINGS = ('crossref_registrant', 'crossref_name', 'crossref_email')
+JOURNAL_IDENTIFIER_CACHE_KEY = 'ezid_journal_identifiers_{}'
+JOURNAL_IDENTIFIER_CACHE_TIMEOUT = 60 * 60
+
+# per repository DOI coverage for the manager page, aggregated at most once per timeout
+DOI_COVERAGE_CACHE_KEY = 'ezid_doi_coverage'
+DOI_COVERAGE_CACHE_TIMEOUT = 60
+# seconds a dead job keeps counting as failed on the manager page
+DEFAULT_COVERAGE_FAILED_WINDOW = 7 * 24 * 60 * 60
+# the queue worker's recent EZID latency, shared with the web processes through the cache
+HTTP_LATENCY_CACHE_KEY = 'ezid_http_latency'
+HTTP_LATENCY_CACHE_TIMEOUT = 15 * 60
+
+# removed from the rendered Crossref XML, which goes on a single ANVL line
+STRIP_NEWLINES = str.maketrans('', '', '\r\n')
+
+# closes the doi_batch opened by journal_batch_head.xml
+JOURNAL_BATCH_TAIL = '    </body>\n</doi_batch>\n'
+
+# default EZID_UPDATE_DEBOUNCE_SECONDS
+DEFAULT_UPDATE_DEBOUNCE_SECONDS = 5 * 60
+
+# stands in for the deposit timestamp when fingerprinting payloads
+FINGERPRINT_NOW = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
 
 # disable to too many branches warning for PyLint
 # pylint: disable=R0912
@@ -81,119 +122,63 @@ def normalize_author_metadata(preprint_authors):
 
     return author_list
 
-class EzidHTTPErrorProcessor(urlreq.HTTPErrorProcessor):
-    ''' Error Processor, required to let 201 responses pass '''
-    def http_response(self, request, response):
-        if response.code == 201:
-            my_return = response
-        else:
-            my_return = urlreq.HTTPErrorProcessor.http_response(self, request, response)
-        return my_return
-    https_response = http_response
+def get_ezid_client(username, password, endpoint_url):
+    ''' returns the shared, pooled EZID client for the given endpoint and credentials '''
+    return registry.get_client(username, password, endpoint_url)
 
-def send_create_request(data, id, username, password, endpoint_url):
-    ''' sends a create request to EZID '''
-    method = "PUT"
-    path = 'id/doi:{}'.format(encode(id))
-    request_url = f"{endpoint_url}/{path}"
+def reserve_ezid_connections(ezid_config, count):
+    ''' makes the shared client for ezid_config keep enough connections open for `count` concurrent requests '''
+    registry.get_config_client(ezid_config).ensure_pool_size(count)
 
-    opener = urlreq.build_opener(EzidHTTPErrorProcessor())
-    ezid_handler = urlreq.HTTPBasicAuthHandler()
-    ezid_handler.add_password("EZID", endpoint_url, username, password)
-    opener.add_handler(ezid_handler)
+def ezid_is_up(ezid_config):
+    ''' checks EZID's status endpoint for the given config '''
+    return registry.get_config_client(ezid_config).is_up()
 
-    request = urlreq.Request(request_url)
-    request.get_method = lambda: method
-    request.add_header("Content-Type", "text/plain; charset=UTF-8")
-    request.data = data.encode("UTF-8")
+def ezid_circuit_open(ezid_config):
+    ''' returns True while requests for the given config are being refused after repeated EZID failures '''
+    return registry.get_config_client(ezid_config).breaker.is_open
 
+def send_ezid_request(action, send, *args):
+    ''' runs a client call, returns the EZID response body, or an "error: ..." string once retries are exhausted '''
     try:
-        connection = opener.open(request)
-        response = connection.read()
-        return response.decode("UTF-8")
-
-    except urlreq.HTTPError as ezid_error:
-        #print("%d %s\n" % (ezid_error.code, ezid_error.msg))
-        if ezid_error.fp is not None:
-            response = ezid_error.fp.read().decode("utf-8")
-            if not response.endswith("\n"):
-                response += "\n"
-            #print(response)
-        return response
+        with metrics.timer(metrics.PHASE_HTTP):
+            status, reason, response = send(*args)
+    except (client.EZIDTransportError, client.EZIDCircuitOpenError) as ezid_error:
+        metrics.count(action, metrics.OUTCOME_TRANSPORT_ERROR)
+        logger.error('EZID {} request failed ({}): {}'.format(action, type(ezid_error).__name__, ezid_error.as_result()))
+        return ezid_error.as_result()
+    except client.EZIDError as ezid_error:
+        metrics.count(action, metrics.OUTCOME_EZID_ERROR)
+        logger.error('EZID {} request failed ({}): {}'.format(action, type(ezid_error).__name__, ezid_error.as_result()))
+        return ezid_error.as_result()
+    metrics.count(action, metrics.OUTCOME_SUCCESS)
+    return response
+
+def send_create_request(data, id, username, password, endpoint_url):
+    ''' sends a create request to EZID '''
+    ezid_client = get_ezid_client(username, password, endpoint_url)
+    return send_ezid_request('create', ezid_client.create, id, data)
 
 def send_mint_request(data, shoulder, username, password, endpoint_url):
     ''' sends a mint request to EZID '''
-    method = "POST"
-    path = 'shoulder/' + encode(shoulder)
-
-    opener = urlreq.build_opener(EzidHTTPErrorProcessor())
-    ezid_handler = urlreq.HTTPBasicAuthHandler()
-    ezid_handler.add_password("EZID", endpoint_url, username, password)
-    opener.add_handler(ezid_handler)
-
-
-    request = urlreq.Request("%s/%s" % (endpoint_url, path))
-    request.get_method = lambda: method
-    request.add_header("Content-Type", "text/plain; charset=UTF-8")
-    request.data = data.encode("UTF-8")
-
-    try:
-        connection = opener.open(request)
-        response = connection.read()
-        return response.decode("UTF-8")
-
-    except urlreq.HTTPError as ezid_error:
-        print("%d %s\n" % (ezid_error.code, ezid_error.msg))
-        if ezid_error.fp is not None:
-            response = ezid_error.fp.read()
-           # FIXME: this code throws errors, endswith doesn't work with response
-           # if not response.endswith("\n"):
-           #     response += "\n"
-            print(response)
+    ezid_client = get_ezid_client(username, password, endpoint_url)
+    return send_ezid_request('mint', ezid_client.mint, shoulder, data)
 
 def send_update_request(data, update_id, username, password, endpoint_url):
     ''' sends an update request to EZID '''
-    method = "POST"
-    path = 'id/doi:' + encode(update_id)
-
-    # print('path: ' + path)
-
-    opener = urlreq.build_opener(EzidHTTPErrorProcessor())
-    ezid_handler = urlreq.HTTPBasicAuthHandler()
-    ezid_handler.add_password("EZID", endpoint_url, username, password)
-    opener.add_handler(ezid_handler)
-
-    request = urlreq.Request("%s/%s" % (endpoint_url, path))
-    request.get_method = lambda: method
-    request.add_header("Content-Type", "text/plain; charset=UTF-8")
-    request.data = data.encode("UTF-8")
-
-    try:
-        connection = opener.open(request)
-        response = connection.read()
-        return response.decode("UTF-8")
-
-    except urlreq.HTTPError as ezid_error:
-        print("%d %s\n" % (ezid_error.code, ezid_error.msg))
-        if ezid_error.fp is not None:
-            response = ezid_error.fp.read().decode("utf-8")
-            if not response.endswith("\n"):
-                response += "\n"
-            print(response)
-
-def encode(txt):
-    ''' encode a text string '''
-    return quote(txt, ":/")
-
-def mint_doi_via_ezid(ezid_config, ezid_metadata, template):
-    ''' Sends a mint request for the specified config, using the provided data '''
-    # ezid_config dictionary contains values for the following keys: shoulder, username, password, endpoint_url
-    # ezid_data dicitionary contains values for the following keys: target_url, group_title, contributors, title, published_date, accepted_date
-
-    # add a timestamp to our metadata, we'll need it
-    ezid_metadata['now'] = timezone.now()
-
-    if ezid_metadata.get('published_doi') is not None:
+    ezid_client = get_ezid_client(username, password, endpoint_url)
+    return send_ezid_request('update', ezid_client.update, update_id, data)
+
+def send_get_request(identifier, username, password, endpoint_url):
+    ''' fetches an identifier's metadata from EZID '''
+    ezid_client = get_ezid_client(username, password, endpoint_url)
+    return send_ezid_request('get', ezid_client.get, identifier)
+
+def validate_published_doi(ezid_metadata):
+    ''' drops published_doi from the metadata when it is not usable as a URL '''
+    if ezid_metadata.get('published_doi') is None:
+        return
+    with metrics.timer(metrics.PHASE_VALIDATE):
         #we cannot trust that the published_doi has been validated, or is usable as a URL, so let's do that now
         logger.debug('validating published_doi')
         validator = URLValidator()
@@ -203,98 +188,311 @@ def mint_doi_via_ezid(ezid_config, ezid_metadata, template):
             logger.error('invalid URL, published_doi: %s for preprint: %s', ezid_metadata.get('published_doi'), ezid_metadata.get('target_url'))
             del ezid_metadata['published_doi'] # this is not a permanent deletion
 
-    template_context = ezid_metadata
-    crossref_template = render_to_string(template, template_context)
+@lru_cache(maxsize=None)
+def get_crossref_template(template):
+    ''' returns the compiled crossref template, it is only loaded and parsed once per process '''
+    return get_template(template)
+
+def render_crossref(template, ezid_metadata):
+    ''' renders the crossref template, same output as render_to_string(template, ezid_metadata) without looking it up every time '''
+    with metrics.timer(metrics.PHASE_RENDER):
+        return get_crossref_template(template).render(ezid_metadata)
+
+def build_ezid_payload(ezid_config, ezid_metadata, template, status=None, check_schema=False):
+    '''
+    renders the crossref template and returns the ANVL payload to send to EZID, optionally setting _status
+
+    with check_schema, raises preflight.PreflightError if the record does not validate against its Crossref schema
+    '''
+    crossref_template = render_crossref(template, ezid_metadata)
 
     logger.debug(crossref_template)
 
-    metadata = crossref_template.replace('\n', '').replace('\r', '')
+    if check_schema:
+        with metrics.timer(metrics.PHASE_PREFLIGHT):
+            preflight.check(template, crossref_template)
 
-    # uncomment this to validate the metadata payload
-    # print('\n\n')
-    # print('Using this metadata:')
-    # print('\n\n')
-    # print(metadata)
+    # build the payload with a single join, the newlines are stripped in one pass
+    parts = ['crossref: ', crossref_template.translate(STRIP_NEWLINES),
+             '\n_crossref: yes\n_profile: crossref\n_target: ', ezid_metadata['target_url'],
+             '\n_owner: ', ezid_config['owner']]
+    if status is not None:
+        parts += ['\n_status: ', status]
+    return ''.join(parts)
 
-    # build the payload
-    payload = 'crossref: ' + metadata + '\n_crossref: yes\n_profile: crossref\n_target: ' + ezid_metadata['target_url'] + '\n_owner: ' + ezid_config['owner']
+def payload_fingerprint(ezid_config, ezid_metadata, template):
+    ''' returns a hash of the payload that ignores the deposit timestamp, so unchanged metadata hashes the same '''
+    fingerprint_metadata = dict(ezid_metadata, now=FINGERPRINT_NOW)
+    payload = build_ezid_payload(ezid_config, fingerprint_metadata, template)
+    return hashlib.sha256(payload.encode('UTF-8')).hexdigest()
 
-    # print('\n\npayload:\n\n')
-    # print(payload)
+def get_payload_fingerprint(doi):
+    ''' returns the fingerprint of the last successful deposit for the DOI, or None '''
+    return EZIDPayloadFingerprint.objects.filter(doi=doi).values_list('fingerprint', flat=True).first()
 
-    return send_mint_request(payload, ezid_config['shoulder'], ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
+def save_payload_fingerprint(doi, fingerprint):
+    EZIDPayloadFingerprint.objects.update_or_create(doi=doi, defaults={'fingerprint': fingerprint})
 
-def update_doi_via_ezid(ezid_config, ezid_metadata, template):
-    ''' Sends an update request for the specified config, using the provided data '''
+def forget_payload_fingerprint(doi):
+    ''' makes the next update of the DOI send its metadata even if it looks unchanged '''
+    EZIDPayloadFingerprint.objects.filter(doi=doi).delete()
+
+def mint_doi_via_ezid(ezid_config, ezid_metadata, template):
+    ''' Sends a mint request for the specified config, using the provided data '''
     # ezid_config dictionary contains values for the following keys: shoulder, username, password, endpoint_url
-    # ezid_metadata dicitionary contains values for the following keys: update_id, target_url, group_title, contributors, title, published_date, accepted_date
+    # ezid_data dicitionary contains values for the following keys: target_url, group_title, contributors, title, published_date, accepted_date
 
     # add a timestamp to our metadata, we'll need it
     ezid_metadata['now'] = timezone.now()
 
-    if ezid_metadata.get('published_doi') is not None:
-        #we cannot trust that the published_doi has been validated, or is usable as a URL, so let's do that now
-        logger.debug('validating published_doi')
-        validator = URLValidator()
-        try:
-            validator(ezid_metadata.get('published_doi'))
-        except ValidationError:
-            logger.error('invalid URL, published_doi: %s for preprint: %s', ezid_metadata.get('published_doi'), ezid_metadata.get('target_url'))
-            del ezid_metadata['published_doi'] # this is not a permanent deletion
+    validate_published_doi(ezid_metadata)
 
-    template_context = ezid_metadata
-    crossref_template = render_to_string(template, template_context)
+    try:
+        payload = build_ezid_payload(ezid_config, ezid_metadata, template, check_schema=preflight.is_enabled())
+    except preflight.PreflightError as error:
+        logger.error('EZID mint not sent: {}'.format(error))
+        return error.as_result()
 
-    logger.debug(crossref_template)
+    return send_mint_request(payload, ezid_config['shoulder'], ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
 
-    metadata = crossref_template.replace('\n', '').replace('\r', '')
+def update_doi_via_ezid(ezid_config, ezid_metadata, template, status=None):
+    ''' Sends an update request for the specified config, using the provided data '''
+    # ezid_config dictionary contains values for the following keys: shoulder, username, password, endpoint_url
+    # ezid_metadata dicitionary contains values for the following keys: update_id, target_url, group_title, contributors, title, published_date, accepted_date
 
-    # uncomment this to validate the metadata payload
-    # print('\n\n')
-    # print('Using this metadata:')
-    # print('\n\n')
-    # print(metadata)
+    # add a timestamp to our metadata, we'll need it
+    ezid_metadata['now'] = timezone.now()
 
-    # build the payload
-    payload = 'crossref: ' + metadata + '\n_crossref: yes\n_profile: crossref\n_target: ' + ezid_metadata['target_url'] + '\n_owner: ' + ezid_config['owner']
+    validate_published_doi(ezid_metadata)
 
-    # print('\n\npayload:\n\n')
-    # print(payload)
+    try:
+        payload = build_ezid_payload(ezid_config, ezid_metadata, template, status=status, check_schema=preflight.is_enabled())
+    except preflight.PreflightError as error:
+        logger.error('EZID update not sent: {}'.format(error))
+        return error.as_result()
 
     return send_update_request(payload, ezid_metadata['update_id'], ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
 
+def publish_doi_via_ezid(ezid_config, ezid_metadata, template):
+    ''' Sends the full metadata for a reserved DOI and makes it public '''
+    return update_doi_via_ezid(ezid_config, ezid_metadata, template, status='public')
+
+def reserve_doi_via_ezid(ezid_config, target_url):
+    ''' Mints a reserved DOI, with no Crossref metadata yet, returns the DOI or None '''
+    payload = '_status: reserved\n_profile: crossref\n_target: ' + target_url + '\n_owner: ' + ezid_config['owner']
+    ezid_result = send_mint_request(payload, ezid_config['shoulder'], ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
+    if isinstance(ezid_result, str) and ezid_result.startswith('success:'):
+        return parse_doi(ezid_result)
+    logger.error('EZID DOI reservation failed: {}'.format(ezid_result))
+    return None
+
+def get_ezid_record(ezid_config, doi):
+    ''' returns the metadata EZID holds for the DOI as a dict of ANVL fields, or the "error: ..." response '''
+    ezid_result = send_get_request(doi, ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
+    if not ezid_result.startswith('success:'):
+        return ezid_result
+    with metrics.timer(metrics.PHASE_PARSE):
+        return client.parse_anvl(ezid_result.partition('\n')[2])
+
+def crossref_summary(crossref_xml):
+    ''' returns the title and (given name, surname) authors of a crossref record, or None if it is not valid XML '''
+    try:
+        root = ElementTree.fromstring(crossref_xml)
+    except ElementTree.ParseError:
+        return None
+
+    def local_name(element):
+        return element.tag.rsplit('}', 1)[-1]
+
+    title = next((element.text or '' for element in root.iter() if local_name(element) == 'title'), '')
+    authors = []
+    for person in (element for element in root.iter() if local_name(element) == 'person_name'):
+        names = {local_name(child): ' '.join((child.text or '').split()) for child in person}
+        authors.append((names.get('given_name', ''), names.get('surname', '')))
+    return {'title': ' '.join(title.split()), 'authors': authors}
+
+def compare_ezid_record(ezid_metadata, template, record):
+    '''
+    compares an EZID record with what would be sent for ezid_metadata now
+
+    returns a list of (field, Janeway value, EZID value) tuples for the target URL, title and
+    authors that differ, empty when the record is in sync
+    '''
+    # EZID stores the percent decoded ANVL value, decode the rendered record the same way
+    rendered = render_crossref(template, dict(ezid_metadata, now=FINGERPRINT_NOW))
+    expected = crossref_summary(unquote(rendered.translate(STRIP_NEWLINES)))
+    actual = crossref_summary(record['crossref']) if record.get('crossref') else None
+
+    differences = []
+    if record.get('_target') != ezid_metadata['target_url']:
+        differences.append(('target', ezid_metadata['target_url'], record.get('_target', '')))
+    if actual is None:
+        differences.append(('crossref', 'present', 'missing or unparseable'))
+        return differences
+    if expected['title'] != actual['title']:
+        differences.append(('title', expected['title'], actual['title']))
+    if expected['authors'] != actual['authors']:
+        differences.append(('authors', format_authors(expected['authors']), format_authors(actual['authors'])))
+    return differences
+
+def format_authors(authors):
+    return '; '.join(' '.join(name for name in author if name) for author in authors)
+
+def retarget_doi_via_ezid(ezid_config, doi, target_url):
+    ''' points the DOI at a new URL, sending only the _target field rather than the whole crossref record '''
+    return send_update_request('_target: ' + target_url, doi, ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
+
+def update_doi_if_changed(ezid_config, ezid_metadata, template, force=False):
+    '''
+    Sends an update request unless the metadata matches the last successful deposit for the DOI
+
+    returns an (outcome, ezid_result) tuple, outcome is one of UPDATE_SKIPPED, UPDATE_CHANGED
+    (a different payload was deposited before) or UPDATE_SENT (no earlier deposit is known)
+    '''
+    doi = ezid_metadata['update_id']
+    validate_published_doi(ezid_metadata)
+    fingerprint = payload_fingerprint(ezid_config, ezid_metadata, template)
+    previous_fingerprint = get_payload_fingerprint(doi)
+
+    if fingerprint == previous_fingerprint and not force:
+        logger.debug('DOI {} metadata unchanged, skipping update'.format(doi))
+        return UPDATE_SKIPPED, None
+
+    ezid_result = update_doi_via_ezid(ezid_config, ezid_metadata, template)
+    if isinstance(ezid_result, str) and ezid_result.startswith('success:'):
+        save_payload_fingerprint(doi, fingerprint)
+
+    return (UPDATE_CHANGED if previous_fingerprint else UPDATE_SENT), ezid_result
+
 def create_doi_via_ezid(ezid_config, ezid_metadata, template):
     ''' Sends a create request for the specified config, using the provided data '''
 
     ezid_metadata['now'] = timezone.now()
 
-    template_context = ezid_metadata
-    crossref_template = render_to_string(template, template_context)
-
-    logger.debug(crossref_template)
-
-    metadata = crossref_template.replace('\n', '').replace('\r', '')
+    try:
+        payload = build_ezid_payload(ezid_config, ezid_metadata, template, check_schema=preflight.is_enabled())
+    except preflight.PreflightError as error:
+        logger.error('EZID create not sent: {}'.format(error))
+        return error.as_result()
 
-    # uncomment this to validate the metadata payload
-    # print('\n\n')
-    # print('Using this metadata:')
-    # print('\n\n')
-    # print(metadata)
+    return send_create_request(payload, ezid_metadata['doi'], ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
 
-    # build the payload
-    payload = 'crossref: ' + metadata + '\n_crossref: yes\n_profile: crossref\n_target: ' + ezid_metadata['target_url'] + '\n_owner: ' + ezid_config['owner']
+def parse_doi(ezid_result):
+    ''' returns the DOI from a successful EZID response '''
+    with metrics.timer(metrics.PHASE_PARSE):
+        return re.search("doi:([0-9A-Z./]+)", ezid_result).group(1)
 
-    # print('\n\npayload:\n\n')
-    # print(payload)
+def get_ezid_config(repo):
+    ''' returns the ezid_config dictionary for the given repository, from the registry '''
+    with metrics.timer(metrics.PHASE_SETTINGS):
+        return registry.get_repository_config(repo)
 
-    return send_create_request(payload, ezid_metadata['doi'], ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
+def get_repository_url(repo, path=None):
+    ''' returns the absolute URL of a path on the repository site '''
+    try:
+        return repo.site_url(path)
+    except AttributeError:
+        # let's just grab the first Press object and hope
+        first_press = press_models.Press.get_press(None)
+        return first_press.repository_path_url(repo, path)
+
+def get_target_url_mapping():
+    ''' returns the (old prefix, new prefix) pairs of EZID_TARGET_URL_MAPPING, longest old prefix first '''
+    mapping = getattr(settings, 'EZID_TARGET_URL_MAPPING', None) or ()
+    return sorted(mapping, key=lambda prefixes: len(prefixes[0]), reverse=True)
+
+def map_target_url(target_url, mapping=None):
+    ''' returns target_url with its old prefix replaced by the new one, or None if no old prefix matches '''
+    for old_prefix, new_prefix in get_target_url_mapping() if mapping is None else mapping:
+        if target_url.startswith(old_prefix):
+            return new_prefix + target_url[len(old_prefix):]
+    return None
+
+def get_preprint_target_url(preprint):
+    '''
+    returns the landing page URL a preprint DOI should resolve to
+
+    EZID_TARGET_URL_MAPPING rewrites it, so every request (full updates, replays, reconciliation)
+    keeps sending the URL a migration moved the DOI to
+    '''
+    target_url = get_repository_url(preprint.repository, preprint.local_url)
+    return map_target_url(target_url) or target_url
+
+# related objects read by get_preprint_metadata, load them up front to avoid a query per preprint
+PREPRINT_METADATA_SELECT = ('repository',)
+PREPRINT_METADATA_PREFETCH = (
+    'subject',
+    Prefetch('preprintauthor_set', queryset=PreprintAuthor.objects.select_related('account')),
+)
+
+def get_preprint_metadata(preprint):
+    ''' returns the ezid_metadata dictionary needed to mint a DOI for the given preprint '''
+    with metrics.timer(metrics.PHASE_METADATA):
+        return _get_preprint_metadata(preprint)
+
+def _get_preprint_metadata(preprint):
+    # the first subject is used as the group_title, iterate over .all() so prefetched subjects are used
+    subjects = list(preprint.subject.all())
+    return {'target_url': get_preprint_target_url(preprint),
+            'group_title': subjects[0].name,
+            'contributors': normalize_author_metadata(preprint.preprintauthor_set.all()),
+            'title': preprint.title.replace('%', '%25'),
+            'abstract': preprint.abstract.replace('%', '%25'),
+            'published_doi': preprint.doi,
+            'published_date': {'month':preprint.date_published.month, 'day':preprint.date_published.day, 'year':preprint.date_published.year},
+            'accepted_date': {'month':preprint.date_accepted.month, 'day':preprint.date_accepted.day, 'year':preprint.date_accepted.year}}
+
+def prefetch_preprint_metadata(preprints):
+    ''' loads the related objects get_preprint_metadata needs for a list of preprints, in a fixed number of queries '''
+    prefetch_related_objects(preprints, *PREPRINT_METADATA_SELECT)
+    prefetch_related_objects(preprints, *PREPRINT_METADATA_PREFETCH)
+
+def preprint_metadata_batches(queryset, batch_size=500):
+    '''
+    yields lists of (preprint, ezid_metadata) tuples for the preprints in the queryset, in pk order
+
+    each batch costs the same handful of queries however many authors and subjects the preprints have;
+    ezid_metadata is None (and the reason logged) for preprints missing required metadata
+    '''
+    queryset = queryset.select_related(*PREPRINT_METADATA_SELECT).prefetch_related(*PREPRINT_METADATA_PREFETCH)
+    batches = bulk.stream_queryset_batches(queryset, batch_size)
+    while True:
+        # the batch queries are part of gathering metadata too
+        with metrics.timer(metrics.PHASE_METADATA):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        contexts = []
+        for preprint in batch:
+            try:
+                ezid_metadata = get_preprint_metadata(preprint)
+            except (IndexError, AttributeError) as error:
+                logger.error('EZID: unable to gather metadata for preprint.pk: {}: {}'.format(preprint.pk, error))
+                ezid_metadata = None
+            contexts.append((preprint, ezid_metadata))
+        yield contexts
+
+def preprint_metadata_contexts(queryset, batch_size=500):
+    ''' yields a (preprint, ezid_metadata) tuple for each preprint in the queryset, see preprint_metadata_batches '''
+    for batch in preprint_metadata_batches(queryset, batch_size):
+        for context in batch:
+            yield context
+
+def save_minted_doi(preprint, ezid_result):
+    ''' stores the DOI from a successful mint response on the preprint, returns the new DOI or None '''
+    if isinstance(ezid_result, str) and ezid_result.startswith('success:'):
+        new_doi = parse_doi(ezid_result)
+        preprint.preprint_doi = new_doi
+        # only the DOI changed, which must not look like a metadata edit to preprint_saved
+        preprint.save(update_fields=['preprint_doi'])
+        return new_doi
+    return None
 
 def preprint_publication(**kwargs):
     ''' hook script for the preprint_publication event '''
-    logger.debug('>>> preprint_publication called, mint an EZID DOI...')
+    logger.debug('>>> preprint_publication called, queue an EZID DOI mint...')
 
     preprint = kwargs.get('preprint')
-    request = kwargs.get('request')
 
     # check to see if this preprint already has a DOI, if so, our job is done, do not try to make a new one
     if preprint.preprint_doi:
@@ -303,98 +501,361 @@ def preprint_publication(**kwargs):
         logger.debug('No need to mint a new DOI, skipping.')
         return None
 
-    # gather metadata required for minting a DOI via EZID
-    target_url = preprint.url
-
-    group_title = preprint.subject.values_list()[0][2]
-    title = preprint.title.replace('%', '%25')
-    published_doi = preprint.doi
-    abstract = preprint.abstract.replace('%', '%25')
-    accepted_date = {'month':preprint.date_accepted.month, 'day':preprint.date_accepted.day, 'year':preprint.date_accepted.year}
-    published_date = {'month':preprint.date_published.month, 'day':preprint.date_published.day, 'year':preprint.date_published.year}
-
-
-    contributors = normalize_author_metadata(preprint.preprintauthor_set.all())
-
-    #some notes on the metatdata required:
-    # [x] target_url (direct link to preprint)
-    # [x] group_title ( preprint.subject.values_list()[0][2] ) grab the first subject
-    # [x] contributors - needs to be a list, with a dictionary per row:
-    # "person_name": [{"@sequence": "first", "@contributor_role": "author", "given_name": "Hardy", "surname": "Pottinger", "ORCID": "https://orcid.org/0000-0001-8549-9354"},]
-    # (preprint.preprintauthor_set is an object ref, work with it, preprintauthor_set.all() would get you a list of all authors)
-    # [x] title (preprint.title)
-    # [x] posted_date (preprint.date_published, is a datetime object)
-    # [x] acceptance_date (preprint.date_accepted, is a datetime object)
-
-    logger.debug("preprint url: " + target_url)
-    logger.debug("title: " + title)
-    logger.debug("group_title: " + group_title)
-    logger.debug("contributors: " + json.dumps(contributors))
-    logger.debug("accepted_date: " + json.dumps(accepted_date))
-    logger.debug("published_date: " + json.dumps(published_date))
-
-    logger.debug('BEGIN MINTING REQUEST...')
-
-    # prepare two dictionaries to feed into the mint_doi_via_ezid function
+    # repositories that do not use EZID get no job, it could only fail until it is marked dead
+    if registry.find_repository_config(preprint.repository) is None:
+        logger.debug('repository {} has no EZID settings, skipping.'.format(preprint.repository))
+        return None
 
-    ezid_settings = RepoEZIDSettings.objects.get(repo=preprint.repository)
-    ezid_config = {'shoulder': ezid_settings.ezid_shoulder,
-                   'username': ezid_settings.ezid_username,
-                   'password': ezid_settings.ezid_password,
-                   'endpoint_url': ezid_settings.ezid_endpoint_url,
-                   'owner': ezid_settings.ezid_owner}
-    ezid_metadata = {'target_url': target_url, 'group_title': group_title, 'contributors': contributors, 'title': title, 'published_date': published_date, 'accepted_date': accepted_date, 'published_doi': published_doi, 'abstract': abstract}
+    # take a DOI reserved ahead of time if there is one, the metadata is sent (and the DOI made public) by the
+    # process_ezid_queue worker, keeping EZID out of the moderator's request either way
+    if claim_reserved_doi(preprint):
+        enqueue_preprint_job(preprint, EZIDJob.ACTION_PUBLISH)
+    else:
+        enqueue_preprint_job(preprint, EZIDJob.ACTION_MINT)
+
+def claim_reserved_doi(preprint):
+    ''' assigns an unclaimed reserved DOI from the repository's pool to the preprint, returns the DOI or None '''
+    with transaction.atomic():
+        reserved_doi = EZIDReservedDOI.objects.select_for_update(skip_locked=True).filter(
+            ezid_settings__repo=preprint.repository,
+            preprint__isnull=True,
+        ).order_by('pk').first()
+        if reserved_doi is None:
+            return None
+
+        reserved_doi.preprint = preprint
+        reserved_doi.date_claimed = timezone.now()
+        reserved_doi.save()
+        preprint.preprint_doi = reserved_doi.doi
+        preprint.save(update_fields=['preprint_doi'])
+
+    logger.debug('reserved DOI {} claimed for preprint.pk: {}'.format(reserved_doi.doi, preprint.pk))
+    return reserved_doi.doi
+
+def reserved_doi_pool_stats(ezid_settings):
+    ''' returns the number of unclaimed reserved DOIs for a RepoEZIDSettings '''
+    return ezid_settings.reserved_dois.filter(preprint__isnull=True).count()
+
+def enqueue_preprint_job(preprint, action):
+    ''' queues an EZID job for the preprint, unless the same job is already waiting to run '''
+    job = EZIDJob.objects.filter(preprint=preprint, action=action, status=EZIDJob.STATUS_PENDING).first()
+    if job is None:
+        job = EZIDJob.objects.create(preprint=preprint, action=action)
+        logger.debug('EZID {} job queued for preprint.pk: {}'.format(action, preprint.pk))
+    return job
+
+def claim_ezid_jobs(limit):
+    ''' marks up to `limit` due jobs as running and returns them, safe to call from several workers at once '''
+    with transaction.atomic():
+        jobs = list(EZIDJob.objects.select_for_update(skip_locked=True).filter(
+            status=EZIDJob.STATUS_PENDING,
+            next_attempt__lte=timezone.now(),
+        ).order_by('next_attempt')[:limit])
+        EZIDJob.objects.filter(pk__in=[job.pk for job in jobs]).update(status=EZIDJob.STATUS_RUNNING, date_updated=timezone.now())
+
+    # load the preprints and their metadata for the whole batch outside the locking query
+    prefetch_related_objects(jobs, 'preprint')
+    prefetch_preprint_metadata([job.preprint for job in jobs])
+    return jobs
+
+def requeue_stale_ezid_jobs(older_than):
+    ''' puts running jobs abandoned by a crashed worker back in the queue, returns how many were requeued '''
+    return EZIDJob.objects.filter(
+        status=EZIDJob.STATUS_RUNNING,
+        date_updated__lt=timezone.now() - older_than,
+    ).update(status=EZIDJob.STATUS_PENDING)
+
+def prepare_preprint_action(preprint, action, force=False):
+    '''
+    returns the (send function, arguments) needed to run an EZIDJob or EZIDOutbox action, or None if
+    there is nothing left to do; force sends an update even if the metadata looks unchanged
+    '''
+    if action == EZIDJob.ACTION_MINT and preprint.preprint_doi:
+        return None
 
-    logger.debug('ezid_config: ' + json.dumps(ezid_config))
-    logger.debug('ezid_metadata: '+ json.dumps(ezid_metadata))
+    ezid_config = get_ezid_config(preprint.repository)
+    if action == EZIDOutbox.ACTION_RETARGET:
+        # only the _target, as retarget_ezid_doi sent it; a DOI outside the shoulder is not EZID's to move
+        if not preprint.preprint_doi or not is_ezid_doi(preprint.preprint_doi, ezid_config):
+            return None
+        return retarget_doi_via_ezid, (ezid_config, preprint.preprint_doi, get_preprint_target_url(preprint))
+
+    ezid_metadata = get_preprint_metadata(preprint)
+
+    if action == EZIDJob.ACTION_UPDATE:
+        ezid_metadata['update_id'] = preprint.preprint_doi
+        validate_published_doi(ezid_metadata)
+        if not force and payload_fingerprint(ezid_config, ezid_metadata, 'ezid/posted_content.xml') == get_payload_fingerprint(preprint.preprint_doi):
+            logger.debug('DOI {} metadata unchanged, skipping update'.format(preprint.preprint_doi))
+            return None
+        return update_doi_via_ezid, (ezid_config, ezid_metadata, 'ezid/posted_content.xml')
+    if action == EZIDJob.ACTION_PUBLISH:
+        ezid_metadata['update_id'] = preprint.preprint_doi
+        return publish_doi_via_ezid, (ezid_config, ezid_metadata, 'ezid/posted_content.xml')
+    return mint_doi_via_ezid, (ezid_config, ezid_metadata, 'ezid/posted_content.xml')
+
+def finish_preprint_action(preprint, action, ezid_result, send_args=None):
+    '''
+    stores the result of an EZIDJob action, returns True if EZID reported success
+
+    send_args are the arguments prepare_preprint_action returned for the request, when given a
+    successful update or publish records the fingerprint of the metadata that was sent
+    '''
+    if action == EZIDJob.ACTION_MINT:
+        return save_minted_doi(preprint, ezid_result) is not None
+    succeeded = isinstance(ezid_result, str) and ezid_result.startswith('success:')
+    if succeeded and send_args is not None and action in (EZIDJob.ACTION_UPDATE, EZIDJob.ACTION_PUBLISH):
+        save_payload_fingerprint(preprint.preprint_doi, payload_fingerprint(*send_args))
+    return succeeded
+
+def prepare_ezid_job(job):
+    ''' returns the (send function, arguments) needed to run the job, or None if there is nothing left to do '''
+    return prepare_preprint_action(job.preprint, job.action)
+
+def finish_ezid_job(job, ezid_result, max_attempts=8, send_args=None):
+    ''' records the outcome of a job, returns True if EZID reported success '''
+    succeeded = finish_preprint_action(job.preprint, job.action, ezid_result, send_args)
+
+    if succeeded:
+        job.status = EZIDJob.STATUS_DONE
+        job.last_error = ''
+        job.save()
+        resolve_ezid_failures(job.action, preprint=job.preprint)
+    else:
+        fail_ezid_job(job, 'ezid_result: {}'.format(ezid_result), max_attempts=max_attempts)
+    return succeeded
+
+def fail_ezid_job(job, error, max_attempts=8, base_delay=60, max_delay=6 * 60 * 60):
+    ''' schedules a retry with exponential backoff, or moves the job to the dead state after max_attempts '''
+    job.attempts += 1
+    job.last_error = str(error)
+    if job.attempts >= max_attempts:
+        job.status = EZIDJob.STATUS_DEAD
+        logger.error('EZID {} job for preprint.pk: {} failed {} times, giving up: {}'.format(job.action, job.preprint_id, job.attempts, error))
+        record_ezid_failure(job.action, error, preprint=job.preprint)
+    else:
+        delay = min(base_delay * 2 ** (job.attempts - 1), max_delay)
+        # spread retries out a little so a backlog does not hit EZID all at once
+        delay += random.uniform(0, delay / 10)
+        job.status = EZIDJob.STATUS_PENDING
+        job.next_attempt = timezone.now() + timedelta(seconds=delay)
+        logger.warning('EZID {} job for preprint.pk: {} failed, retrying in {:.0f}s: {}'.format(job.action, job.preprint_id, delay, error))
+    job.save()
+
+def ezid_queue_stats():
+    ''' returns the queue depth and the age of the oldest waiting job '''
+    pending = EZIDJob.objects.filter(status=EZIDJob.STATUS_PENDING)
+    oldest = pending.order_by('date_created').values_list('date_created', flat=True).first()
+    return {'pending': pending.count(),
+            'running': EZIDJob.objects.filter(status=EZIDJob.STATUS_RUNNING).count(),
+            'dead': EZIDJob.objects.filter(status=EZIDJob.STATUS_DEAD).count(),
+            'oldest_pending_age': timezone.now() - oldest if oldest else None}
+
+def count_where(condition):
+    ''' an aggregate counting the rows that match condition '''
+    return Sum(Case(When(condition, then=1), default=0, output_field=IntegerField()))
+
+def get_doi_coverage():
+    '''
+    returns DOI coverage, pending and failed job counts per repository, from a few aggregate queries;
+    failed counts the jobs that died within EZID_COVERAGE_FAILED_WINDOW seconds for preprints still without a DOI
+
+    the rows are cached for DOI_COVERAGE_CACHE_TIMEOUT seconds, so reloading the manager page does
+    not scan the preprint table again
+    '''
+    coverage = cache.get(DOI_COVERAGE_CACHE_KEY)
+    if coverage is not None:
+        return coverage
+
+    has_doi = Q(preprint_doi__isnull=False) & ~Q(preprint_doi='')
+    rows = Preprint.objects.filter(
+        stage='preprint_published',
+        date_published__lte=timezone.now(),
+    ).values('repository', 'repository__name').annotate(
+        published=Count('pk'),
+        with_doi=count_where(has_doi),
+        oldest_without_doi=Min(Case(When(~has_doi, then='date_published'))),
+    ).order_by('repository__name')
+
+    # a dead job only counts while its preprint is still without a DOI (a replay or rerun may have minted
+    # one since) and for the failed window, so the column shows current gaps rather than history
+    failed_since = timezone.now() - timedelta(seconds=getattr(settings, 'EZID_COVERAGE_FAILED_WINDOW', DEFAULT_COVERAGE_FAILED_WINDOW))
+    preprint_has_doi = Q(preprint__preprint_doi__isnull=False) & ~Q(preprint__preprint_doi='')
+    jobs = {row['preprint__repository']: row for row in EZIDJob.objects.values('preprint__repository').annotate(
+        pending=count_where(Q(status=EZIDJob.STATUS_PENDING)),
+        failed=count_where(Q(status=EZIDJob.STATUS_DEAD, date_updated__gte=failed_since) & ~preprint_has_doi),
+    ).order_by()}
+
+    coverage = []
+    for row in rows:
+        job_counts = jobs.get(row['repository'], {})
+        coverage.append({'repository': row['repository__name'],
+                         'published': row['published'],
+                         'with_doi': row['with_doi'],
+                         'without_doi': row['published'] - row['with_doi'],
+                         'coverage': 100.0 * row['with_doi'] / row['published'] if row['published'] else 100.0,
+                         'pending': job_counts.get('pending', 0),
+                         'failed': job_counts.get('failed', 0),
+                         # a date rather than an age, so the age shown stays right while the row is cached
+                         'oldest_without_doi': row['oldest_without_doi']})
+    cache.set(DOI_COVERAGE_CACHE_KEY, coverage, DOI_COVERAGE_CACHE_TIMEOUT)
+    return coverage
+
+def share_http_latency():
+    ''' copies this process's recent EZID latency to the cache, for the manager page of the web processes '''
+    latency = {'p50': metrics.recent_http_latency(0.5), 'p95': metrics.recent_http_latency(0.95)}
+    if latency['p50'] is not None:
+        cache.set(HTTP_LATENCY_CACHE_KEY, latency, HTTP_LATENCY_CACHE_TIMEOUT)
+
+def get_http_latency():
+    ''' returns the p50 and p95 of recent EZID round trips in seconds, None when there were none lately '''
+    latency = {'p50': metrics.recent_http_latency(0.5), 'p95': metrics.recent_http_latency(0.95)}
+    if latency['p50'] is None:
+        # the web processes queue their work, so the latency usually comes from the queue worker
+        latency = cache.get(HTTP_LATENCY_CACHE_KEY)
+    return latency
+
+def record_ezid_failure(action, error, preprint=None, article=None):
+    ''' puts an unrecoverable EZID failure in the outbox, so replay_ezid_outbox can send it again later '''
+    entry = EZIDOutbox.objects.filter(preprint=preprint, article=article, action=action, resolved=False).first()
+    if entry is None:
+        entry = EZIDOutbox(preprint=preprint, article=article, action=action)
+    entry.error = str(error)
+    entry.save()
+    return entry
+
+def resolve_ezid_failures(action, preprint=None, article=None):
+    ''' marks outbox entries as resolved once the action has succeeded '''
+    EZIDOutbox.objects.filter(preprint=preprint, article=article, action=action, resolved=False).update(
+        resolved=True, date_replayed=timezone.now())
+
+def get_update_debounce():
+    ''' seconds an edited preprint waits before its metadata is sent, later edits push the update back again '''
+    return timedelta(seconds=getattr(settings, 'EZID_UPDATE_DEBOUNCE_SECONDS', DEFAULT_UPDATE_DEBOUNCE_SECONDS))
+
+def get_shoulder_prefix(ezid_config):
+    ''' the config's shoulder without its doi: scheme, the prefix every DOI it minted starts with '''
+    shoulder = ezid_config['shoulder']
+    if shoulder.lower().startswith('doi:'):
+        shoulder = shoulder[len('doi:'):]
+    return shoulder
+
+def is_ezid_doi(doi, ezid_config):
+    ''' True if the DOI was minted under the config's shoulder, e.g. 10.15697/FK2ABC for doi:10.15697/FK2 '''
+    shoulder = get_shoulder_prefix(ezid_config)
+    return bool(shoulder) and doi.upper().startswith(shoulder.upper())
+
+def filter_ezid_dois(preprints, ezid_config):
+    '''
+    narrows a preprint queryset to the preprints whose preprint_doi passes is_ezid_doi, leaving out
+    DOIs EZID would refuse to touch, such as those imported from OSF
+    '''
+    shoulder = get_shoulder_prefix(ezid_config)
+    if not shoulder:
+        return preprints.none()
+    return preprints.filter(preprint_doi__istartswith=shoulder)
+
+def schedule_preprint_update(preprint):
+    '''
+    queues a metadata update for the preprint's DOI, or postpones the one already waiting
+
+    a burst of edits ends up as a single update job, due once the preprint has been left alone for
+    the debounce window; returns the job, or None when no update is needed. Only DOIs minted under
+    the repository's EZID shoulder are updated, imported DOIs (e.g. OSF's) are not EZID's to change
+    '''
+    if not preprint.preprint_doi:
+        return None
+    ezid_config = registry.find_repository_config(preprint.repository)
+    if ezid_config is None or not is_ezid_doi(preprint.preprint_doi, ezid_config):
+        return None
 
-    ezid_result = mint_doi_via_ezid(ezid_config, ezid_metadata, 'ezid/posted_content.xml')
+    pending = EZIDJob.objects.filter(preprint=preprint, status=EZIDJob.STATUS_PENDING)
+    # a queued mint or publish sends the metadata as it is when it runs
+    if pending.filter(action__in=(EZIDJob.ACTION_MINT, EZIDJob.ACTION_PUBLISH)).exists():
+        return None
 
-    # if the ezid_result is a string, it's probably a success, check to be sure
-    if isinstance(ezid_result, str):
-        if ezid_result.startswith('success:'):
-            new_doi = re.search("doi:([0-9A-Z./]+)", ezid_result).group(1)
-            logger.debug('DOI successfully created: ' + new_doi)
-            preprint.preprint_doi = new_doi
-            preprint.save()
-            logger.debug('DOI added to preprint Janeway object and saved. A preprint is born!')
-        else:
-            logger.error('EZID DOI creation failed for preprint.pk: ' + preprint.pk + ' ...')
-            logger.error('ezid_result: ' + ezid_result)
+    due = timezone.now() + get_update_debounce()
+    job = pending.filter(action=EZIDJob.ACTION_UPDATE).first()
+    if job is None:
+        job = EZIDJob.objects.create(preprint=preprint, action=EZIDJob.ACTION_UPDATE, next_attempt=due)
+        logger.debug('EZID update job queued for preprint.pk: {}'.format(preprint.pk))
     else:
-        logger.error('EZID DOI creation failed for preprint.pk: ' + preprint.pk + ' ...')
-        logger.error(ezid_result.msg)
-
-# TODO: PUBD-118 fire a metadata update when a new preprint version is created
-# def preprint_version_update(**kwargs):
-#     ''' hook script for the preprint_version_update event '''
-#     logger.debug('>>> preprint_version_update called, update DOI metadata via EZID...')
+        EZIDJob.objects.filter(pk=job.pk, status=EZIDJob.STATUS_PENDING).update(next_attempt=due, date_updated=timezone.now())
+    return job
 
-#     preprint = kwargs.get('preprint')
-#     request = kwargs.get('request')
+def preprint_version_update(**kwargs):
+    ''' hook script for the preprint version update event, queues a debounced DOI metadata update '''
+    preprint = kwargs.get('preprint')
+    if preprint is not None:
+        schedule_preprint_update(preprint)
+
+@receiver(post_save, sender=Preprint)
+def preprint_saved(sender, instance, created=False, update_fields=None, raw=False, **kwargs):
+    ''' edits to a preprint with a DOI queue a debounced metadata update '''
+    if raw or created:
+        return
+    if update_fields is not None and set(update_fields) <= {'preprint_doi'}:
+        return
+    schedule_preprint_update(instance)
+
+@receiver(post_save, sender=PreprintAuthor)
+@receiver(post_delete, sender=PreprintAuthor)
+def preprint_author_changed(sender, instance, raw=False, **kwargs):
+    ''' adding, editing or removing an author changes the DOI metadata too '''
+    if raw or instance.preprint_id is None:
+        return
+    try:
+        preprint = instance.preprint
+    except Preprint.DoesNotExist:
+        # the preprint is being deleted along with its authors
+        return
+    schedule_preprint_update(preprint)
+
+def get_journal_identifier_settings(journal):
+    ''' returns the journal's Crossref identifier settings, cached until one of them is saved '''
+    cache_key = JOURNAL_IDENTIFIER_CACHE_KEY.format(journal.pk)
+    identifier_settings = cache.get(cache_key)
+    if identifier_settings is None:
+        identifier_settings = {name: setting_handler.get_setting('Identifiers', name, journal).processed_value
+                               for name in JOURNAL_IDENTIFIER_SETTINGS}
+        cache.set(cache_key, identifier_settings, JOURNAL_IDENTIFIER_CACHE_TIMEOUT)
+    return identifier_settings
+
+@receiver(post_save, sender=SettingValue)
+def clear_journal_identifier_settings(sender, instance, **kwargs):
+    ''' drops cached identifier settings when one of them is saved '''
+    setting = instance.setting
+    if setting.group.name != 'Identifiers' or setting.name not in JOURNAL_IDENTIFIER_SETTINGS:
+        return
+    if instance.journal_id is None:
+        # a press wide default changed, it may be what any journal falls back on
+        for journal_pk in journal_models.Journal.objects.values_list('pk', flat=True):
+            cache.delete(JOURNAL_IDENTIFIER_CACHE_KEY.format(journal_pk))
+    else:
+        cache.delete(JOURNAL_IDENTIFIER_CACHE_KEY.format(instance.journal_id))
 
-#     logger.debug("preprint.id = " + preprint.id)
-#     logger.debug("request: " + request)
+def render_journal_article(ezid_metadata):
+    ''' renders the <journal> record of one article, as journal_content.xml embeds it, for multi-article deposits '''
+    return render_crossref('ezid/journal_article.xml', ezid_metadata)
 
 def get_journal_metadata(article):
     target_url = article.remote_url
+    with metrics.timer(metrics.PHASE_SETTINGS):
+        identifier_settings = get_journal_identifier_settings(article.journal)
 
-    ezid_config = { 'username': USERNAME,
-                    'password': PASSWORD,
-                    'endpoint_url': ENDPOINT_URL,
-                    'owner': setting_handler.get_setting('Identifiers', 'crossref_registrant', article.journal).processed_value,}
+    ezid_config = registry.get_journal_config(identifier_settings['crossref_registrant'])
     ezid_metadata = {'target_url': target_url,
                      'article': article,
                      'doi': article.get_doi(),
-                     'depositor_name': setting_handler.get_setting('Identifiers', 'crossref_name', article.journal).processed_value,
-                     'depositor_email': setting_handler.get_setting('Identifiers', 'crossref_email', article.journal).processed_value,
-                     'registrant': setting_handler.get_setting('Identifiers', 'crossref_registrant', article.journal).processed_value,}
+                     'depositor_name': identifier_settings['crossref_name'],
+                     'depositor_email': identifier_settings['crossref_email'],
+                     'registrant': identifier_settings['crossref_registrant'],}
     return ezid_config, ezid_metadata
 
 def process_ezid_result(article, action, ezid_result):
     if isinstance(ezid_result, str):
         if ezid_result.startswith('success:'):
-            doi = re.search("doi:([0-9A-Z./]+)", ezid_result).group(1)
+            doi = parse_doi(ezid_result)
             logger.debug('DOI {} success: {}'.format(action, doi))
             return True, ezid_result
         else:
@@ -402,22 +863,45 @@ def process_ezid_result(article, action, ezid_result):
             logger.error('ezid_result: ' + ezid_result)
     else:
         logger.error('EZID DOI {} failed for article.pk: {}...'.format(action, article.pk))
-        logger.error(ezid_result.msg)
+        logger.error('ezid_result: {}'.format(ezid_result))
 
     return False, ezid_result
 
-def update_journal_doi(article):
+def update_journal_doi(article, force=False):
+    '''
+    sends the article metadata to EZID unless it has not changed, returns an (outcome, success, ezid_result)
+    tuple where outcome is UPDATE_SKIPPED, UPDATE_SENT or UPDATE_CHANGED as for update_doi_if_changed,
+    and ezid_result is None when nothing was sent
+    '''
     ezid_config, ezid_metadata = get_journal_metadata(article)
 
     ezid_metadata['update_id'] = article.get_doi()
 
-    ezid_result = update_doi_via_ezid(ezid_config, ezid_metadata, 'ezid/journal_content.xml')
+    outcome, ezid_result = update_doi_if_changed(ezid_config, ezid_metadata, 'ezid/journal_content.xml', force=force)
+    if outcome == UPDATE_SKIPPED:
+        return outcome, True, None
 
-    return process_ezid_result(article, "update", ezid_result)
+    success, ezid_result = process_ezid_result(article, "update", ezid_result)
+    if success:
+        resolve_ezid_failures(EZIDOutbox.ACTION_JOURNAL_UPDATE, article=article)
+    else:
+        record_ezid_failure(EZIDOutbox.ACTION_JOURNAL_UPDATE, ezid_result, article=article)
+    return outcome, success, ezid_result
 
 def register_journal_doi(article):
     ezid_config, ezid_metadata = get_journal_metadata(article)
 
+    fingerprint = payload_fingerprint(ezid_config, ezid_metadata, 'ezid/journal_content.xml')
     ezid_result = create_doi_via_ezid(ezid_config, ezid_metadata, 'ezid/journal_content.xml')
 
-    return process_ezid_result(article, "creation", ezid_result)
+    return finish_journal_registration(article, ezid_metadata, fingerprint, ezid_result)
+
+def finish_journal_registration(article, ezid_metadata, fingerprint, ezid_result):
+    ''' records the outcome of a journal DOI create request, returns a (success, ezid_result) tuple '''
+    success, ezid_result = process_ezid_result(article, "creation", ezid_result)
+    if success:
+        save_payload_fingerprint(ezid_metadata['doi'], fingerprint)
+        resolve_ezid_failures(EZIDOutbox.ACTION_JOURNAL_CREATE, article=article)
+    else:
+        record_ezid_failure(EZIDOutbox.ACTION_JOURNAL_CREATE, ezid_result, article=article)
+    return success, ezid_result
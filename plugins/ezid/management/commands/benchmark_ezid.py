@@ -0,0 +1,209 @@
+"""
+Janeway Management command for benchmarking the EZID plugin against a local fake EZID server
+"""
+
+import time
+import urllib.request as urlreq
+from datetime import date
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from plugins.ezid import bulk, client
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+from plugins.ezid.fake_ezid import FakeEZIDServer
+
+SCENARIOS = ('single_mint', 'bulk_mint', 'bulk_update', 'journal_registration', 'legacy_mint', 'render')
+
+class EzidHTTPErrorProcessor(urlreq.HTTPErrorProcessor):
+    ''' Error Processor, required to let 201 responses pass '''
+    def http_response(self, request, response):
+        if response.code == 201:
+            my_return = response
+        else:
+            my_return = urlreq.HTTPErrorProcessor.http_response(self, request, response)
+        return my_return
+    https_response = http_response
+
+def legacy_mint_request(data, shoulder, username, password, endpoint_url):
+    ''' the per-request opener send_mint_request used before the pooled client, kept as the baseline '''
+    opener = urlreq.build_opener(EzidHTTPErrorProcessor())
+    ezid_handler = urlreq.HTTPBasicAuthHandler()
+    ezid_handler.add_password("EZID", endpoint_url, username, password)
+    opener.add_handler(ezid_handler)
+
+    request = urlreq.Request("%s/%s" % (endpoint_url, 'shoulder/' + client.encode(shoulder)))
+    request.get_method = lambda: "POST"
+    request.add_header("Content-Type", "text/plain; charset=UTF-8")
+    request.data = data.encode("UTF-8")
+
+    connection = opener.open(request)
+    return connection.read().decode("UTF-8")
+
+def legacy_mint_doi_via_ezid(ezid_config, ezid_metadata, template):
+    ''' mint_doi_via_ezid with the payload sent through legacy_mint_request instead of the pooled client '''
+    ezid_metadata['now'] = timezone.now()
+    ezid.validate_published_doi(ezid_metadata)
+    payload = ezid.build_ezid_payload(ezid_config, ezid_metadata, template)
+    return legacy_mint_request(payload, ezid_config['shoulder'], ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
+
+def legacy_build_ezid_payload(ezid_config, ezid_metadata, template, status=None):
+    ''' the payload builder used before the compiled template fast path, kept as the baseline '''
+    crossref_template = render_to_string(template, ezid_metadata)
+    metadata = crossref_template.replace('\n', '').replace('\r', '')
+    payload = 'crossref: ' + metadata + '\n_crossref: yes\n_profile: crossref\n_target: ' + ezid_metadata['target_url'] + '\n_owner: ' + ezid_config['owner']
+    if status is not None:
+        payload += '\n_status: ' + status
+    return payload
+
+def preprint_metadata(i):
+    ''' a typical preprint's ezid_metadata, shaped like get_preprint_metadata's '''
+    return {'target_url': 'https://eartharxiv.org/repository/view/{}/'.format(i),
+            'group_title': 'Earth Sciences',
+            'contributors': [{'given_name': 'Author', 'surname': 'Number {}'.format(n),
+                              'ORCID': 'https://orcid.org/0000-0001-8549-935{}'.format(n)} for n in range(4)],
+            'title': 'Benchmark preprint {}: a study of 50%25 of everything'.format(i),
+            'abstract': 'An abstract of a few sentences. ' * 20,
+            'published_doi': None,
+            'published_date': {'month': 1, 'day': 2, 'year': 2020},
+            'accepted_date': {'month': 1, 'day': 1, 'year': 2020}}
+
+def journal_metadata(i, owner):
+    ''' a typical article's ezid_metadata, shaped like get_journal_metadata's '''
+    authors = [SimpleNamespace(order=n, given_names='Author', last_name='Number {}'.format(n), orcid='0000-0001-8549-935{}'.format(n))
+               for n in range(4)]
+    article = SimpleNamespace(
+        pk=i,
+        journal=SimpleNamespace(name='Benchmark Journal', issn='1234-5678'),
+        issue=SimpleNamespace(date=date(2020, 1, 1), volume=1, issue=2),
+        title='Benchmark article {}'.format(i),
+        frozen_authors=SimpleNamespace(exists=lambda: True, all=lambda: authors),
+        abstract='An abstract of a few sentences. ' * 20,
+        date_published=timezone.now(),
+        get_doi=lambda: '10.5072/BENCH{}'.format(i),
+    )
+    return {'target_url': 'https://escholarship.org/uc/item/{}'.format(i),
+            'article': article,
+            'doi': article.get_doi(),
+            'depositor_name': 'Benchmark Depositor',
+            'depositor_email': 'depositor@example.org',
+            'registrant': owner}
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class Command(BaseCommand):
+    """ Measures p50/p95 latency and DOIs/sec of the plugin's DOI workflows against a fake EZID """
+    help = "Benchmarks EZID minting, updating and journal registration against a local fake EZID server."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--requests", help="number of DOIs per scenario", type=int, default=200)
+        parser.add_argument(
+            "--concurrency", help="number of requests in flight at once in the bulk scenarios", type=int, default=4)
+        parser.add_argument(
+            "--latency", help="simulated EZID processing time per request, in milliseconds", type=int, default=0)
+        parser.add_argument(
+            "--error-rate", help="fraction of requests the fake EZID answers with a 500", type=float, default=0)
+        parser.add_argument(
+            "--scenario", help="scenario to run, may be repeated, all of them if omitted", action="append", choices=SCENARIOS)
+        parser.add_argument(
+            "--phases", help="print the time spent in each phase after each scenario", action="store_true")
+
+    def handle(self, *args, **options):
+        self.num_requests = options['requests']
+        self.concurrency = options['concurrency']
+
+        with FakeEZIDServer(latency=options['latency'] / 1000, error_rate=options['error_rate']) as server:
+            self.server = server
+            self.ezid_config = server.ezid_config()
+            ezid.reserve_ezid_connections(self.ezid_config, self.concurrency)
+
+            for scenario in options['scenario'] or SCENARIOS:
+                server.reset()
+                metrics.reset()
+                getattr(self, scenario)()
+                if options['phases']:
+                    metrics.write_summary(self.stdout.write)
+
+    def report(self, label, latencies, succeeded, elapsed):
+        latencies = sorted(latencies)
+        self.stdout.write('{}: {} of {} DOIs in {:.2f}s, {:.1f} DOIs/sec, p50 {:.1f}ms, p95 {:.1f}ms'.format(
+            label, succeeded, len(latencies), elapsed, succeeded / elapsed if elapsed else 0,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000))
+
+    def run(self, label, func, tasks, concurrency):
+        ''' runs func over the (key, args) tasks, timing every call '''
+        latencies = []
+        succeeded = []
+
+        def timed(*args):
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        def on_result(_, ezid_result, error):
+            if error is None and isinstance(ezid_result, str) and ezid_result.startswith('success:'):
+                succeeded.append(ezid_result)
+
+        start = time.perf_counter()
+        bulk.run_concurrently(tasks, timed, on_result, concurrency=concurrency)
+        self.report(label, latencies, len(succeeded), time.perf_counter() - start)
+
+    def mint_tasks(self):
+        return ((i, (self.ezid_config, preprint_metadata(i), 'ezid/posted_content.xml')) for i in range(self.num_requests))
+
+    def single_mint(self):
+        self.run('single mint', ezid.mint_doi_via_ezid, self.mint_tasks(), 1)
+
+    def bulk_mint(self):
+        self.run('bulk mint', ezid.mint_doi_via_ezid, self.mint_tasks(), self.concurrency)
+
+    def bulk_update(self):
+        def tasks():
+            for i in range(self.num_requests):
+                doi = '10.5072/FK2UPDATE{}'.format(i)
+                self.server.identifiers['doi:' + doi] = {'_status': 'public'}
+                ezid_metadata = preprint_metadata(i)
+                ezid_metadata['update_id'] = doi
+                yield i, (self.ezid_config, ezid_metadata, 'ezid/posted_content.xml')
+
+        self.run('bulk update', ezid.update_doi_via_ezid, tasks(), self.concurrency)
+
+    def journal_registration(self):
+        tasks = ((i, (self.ezid_config, journal_metadata(i, self.ezid_config['owner']), 'ezid/journal_content.xml'))
+                 for i in range(self.num_requests))
+        self.run('journal registration', ezid.create_doi_via_ezid, tasks, self.concurrency)
+
+    def legacy_mint(self):
+        '''
+        the bulk mint scenario, same metadata, payloads, fake server and concurrency, with only the transport
+        swapped for the urllib opener per request (a new connection and a 401 challenge for every mint)
+        '''
+        self.run('legacy mint, urllib opener per request', legacy_mint_doi_via_ezid, self.mint_tasks(), self.concurrency)
+
+    def render(self):
+        ''' payloads/sec of the old and the current payload builder, without any HTTP '''
+        now = timezone.now()
+        for label, template, make_metadata in (
+                ('posted content', 'ezid/posted_content.xml', preprint_metadata),
+                ('journal content', 'ezid/journal_content.xml', lambda i: journal_metadata(i, self.ezid_config['owner']))):
+            contexts = [dict(make_metadata(i), now=now) for i in range(self.num_requests)]
+
+            payloads = {}
+            for builder_label, build in (('legacy', legacy_build_ezid_payload), ('current', ezid.build_ezid_payload)):
+                start = time.perf_counter()
+                payloads[builder_label] = [build(self.ezid_config, context, template) for context in contexts]
+                elapsed = time.perf_counter() - start
+                self.stdout.write('render {}, {} builder: {} payloads in {:.2f}s, {:.1f} payloads/sec'.format(
+                    label, builder_label, len(contexts), elapsed, len(contexts) / elapsed if elapsed else 0))
+
+            if payloads['legacy'] != payloads['current']:
+                self.stdout.write(self.style.ERROR('render {}: the builders produced different payloads'.format(label)))
@@ -0,0 +1,99 @@
+"""
+Janeway Management command for minting DOIs for every published preprint in a repository that lacks one
+"""
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from plugins.ezid import aio, bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+from plugins.ezid.models import EZIDOutbox
+from repository import models
+
+class Command(BaseCommand):
+    """ Mints DOIs via EZID, concurrently, for every published preprint in a repository with an empty preprint_doi """
+    help = "Mints DOIs for all published preprints in the repository that do not have one yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "short_name", help="`short_name` for the repository containing the preprints for which we need to mint DOIs", type=str)
+        parser.add_argument(
+            "--concurrency", help="number of mint requests in flight at once", type=int, default=4)
+        parser.add_argument(
+            "--rate", help="maximum number of mint requests per second, unlimited if omitted", type=float, default=None)
+        parser.add_argument(
+            "--limit", help="stop after this many preprints", type=int, default=None)
+        parser.add_argument(
+            "--async", help="send the requests from one asyncio event loop (needs aiohttp), for large runs", action="store_true", dest="use_async")
+
+    def handle(self, *args, **options):
+
+        short_name = options.get('short_name')
+
+        try:
+            repo = models.Repository.objects.get(
+                short_name=short_name,
+            )
+        except models.Repository.DoesNotExist:
+            exit('No repository found.')
+
+        if options['use_async']:
+            try:
+                aio.require_aiohttp()
+            except ImportError as error:
+                raise CommandError(str(error))
+
+        ezid_config = ezid.get_ezid_config(repo)
+        ezid.reserve_ezid_connections(ezid_config, options['concurrency'])
+
+        # preprints get their DOI saved as soon as it is minted, so a re-run only picks up what is left
+        preprints = models.Preprint.objects.filter(
+            Q(preprint_doi__isnull=True) | Q(preprint_doi=''),
+            repository=repo,
+            stage='preprint_published',
+            date_published__lte=timezone.now(),
+        )
+        limit = options['limit']
+
+        self.stdout.write("Minting DOIs for {} published preprints without one...".format(preprints.count()))
+
+        preprint_by_pk = {}
+        minted = []
+        failures = []
+
+        def tasks():
+            for count, (preprint, ezid_metadata) in enumerate(ezid.preprint_metadata_contexts(preprints)):
+                if limit is not None and count >= limit:
+                    return
+                if ezid_metadata is None:
+                    failures.append((preprint.pk, 'unable to gather metadata'))
+                    continue
+                preprint_by_pk[preprint.pk] = preprint
+                yield preprint.pk, (ezid_config, ezid_metadata, 'ezid/posted_content.xml')
+
+        def on_result(preprint_pk, ezid_result, error):
+            preprint = preprint_by_pk.pop(preprint_pk)
+            new_doi = ezid.save_minted_doi(preprint, ezid_result) if error is None else None
+            if new_doi:
+                minted.append(new_doi)
+                self.stdout.write(self.style.SUCCESS('DOI {} minted for preprint {}'.format(new_doi, preprint_pk)))
+            else:
+                failures.append((preprint_pk, str(error or ezid_result).strip()))
+                ezid.record_ezid_failure(EZIDOutbox.ACTION_MINT, error or ezid_result, preprint=preprint)
+
+        start = time.monotonic()
+        if options['use_async']:
+            aio.run_concurrently(tasks(), aio.mint_doi_via_ezid, on_result,
+                                 concurrency=options['concurrency'], rate=options['rate'])
+        else:
+            bulk.run_concurrently(tasks(), ezid.mint_doi_via_ezid, on_result,
+                                  concurrency=options['concurrency'], rate=options['rate'])
+        elapsed = time.monotonic() - start
+
+        self.stdout.write("Minted {} DOIs in {:.1f}s ({:.2f} DOIs/sec), {} failures.".format(
+            len(minted), elapsed, len(minted) / elapsed if elapsed else 0, len(failures)))
+        for preprint_pk, message in failures:
+            self.stdout.write(self.style.ERROR('EZID DOI creation failed for preprint.pk: {} ... {}'.format(preprint_pk, message)))
+        metrics.write_summary(self.stdout.write)
@@ -0,0 +1,155 @@
+"""
+Janeway Management command for updating the DOI metadata of every preprint with a DOI in a repository
+"""
+
+import time
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from plugins.ezid import aio, bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+from plugins.ezid.models import EZIDOutbox, EZIDPayloadFingerprint
+from repository import models
+
+class Command(BaseCommand):
+    """ Streams the preprints with a DOI in a repository and sends their metadata to EZID concurrently """
+    help = "Updates the DOI metadata for all preprints in the repository, optionally filtered."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "short_name", help="`short_name` for the repository containing the preprints to update", type=str)
+        parser.add_argument(
+            "--since", help="only preprints updated on or after this date (YYYY-MM-DD)", type=str, default=None)
+        parser.add_argument(
+            "--subject", help="only preprints with this subject (name or id)", type=str, default=None)
+        parser.add_argument(
+            "--owner", help="only preprints owned by this account (email or id)", type=str, default=None)
+        parser.add_argument(
+            "--concurrency", help="number of update requests in flight at once", type=int, default=4)
+        parser.add_argument(
+            "--rate", help="maximum number of update requests per second, unlimited if omitted", type=float, default=None)
+        parser.add_argument(
+            "--batch-size", help="number of preprints loaded per query", type=int, default=500)
+        parser.add_argument(
+            "--force", help="send updates even if the metadata matches the last deposit", action="store_true")
+        parser.add_argument(
+            "--async", help="send the requests from one asyncio event loop (needs aiohttp), for large runs", action="store_true", dest="use_async")
+
+    def handle(self, *args, **options):
+
+        short_name = options.get('short_name')
+
+        try:
+            repo = models.Repository.objects.get(
+                short_name=short_name,
+            )
+        except models.Repository.DoesNotExist:
+            exit('No repository found.')
+
+        if options['use_async']:
+            try:
+                aio.require_aiohttp()
+            except ImportError as error:
+                raise CommandError(str(error))
+
+        ezid_config = ezid.get_ezid_config(repo)
+        preprints = self.filter_preprints(repo, options)
+        # DOIs outside the repository's shoulder (e.g. imported from OSF) cannot be updated via EZID
+        ezid_preprints = ezid.filter_ezid_dois(preprints, ezid_config)
+        foreign = preprints.count() - ezid_preprints.count()
+        if foreign:
+            self.stdout.write("Skipping {} preprints whose DOI is outside the {} shoulder.".format(foreign, ezid_config['shoulder']))
+        preprints = ezid_preprints
+        ezid.reserve_ezid_connections(ezid_config, options['concurrency'])
+
+        total = preprints.count()
+        self.stdout.write("Updating DOI metadata for {} preprints...".format(total))
+        progress = bulk.Progress(total, self.stdout.write)
+
+        counts = {ezid.UPDATE_SENT: 0, ezid.UPDATE_CHANGED: 0, ezid.UPDATE_SKIPPED: 0}
+        failures = []
+        pending = {}
+
+        def tasks():
+            for batch in ezid.preprint_metadata_batches(preprints, options['batch_size']):
+                # one query for the fingerprints of the whole batch
+                fingerprints = dict(EZIDPayloadFingerprint.objects.filter(
+                    doi__in=[preprint.preprint_doi for preprint, _ in batch],
+                ).values_list('doi', 'fingerprint'))
+
+                for preprint, ezid_metadata in batch:
+                    if ezid_metadata is None:
+                        failures.append((preprint.pk, 'unable to gather metadata'))
+                        progress.step()
+                        continue
+                    ezid_metadata['update_id'] = preprint.preprint_doi
+                    ezid.validate_published_doi(ezid_metadata)
+
+                    fingerprint = ezid.payload_fingerprint(ezid_config, ezid_metadata, 'ezid/posted_content.xml')
+                    previous_fingerprint = fingerprints.get(preprint.preprint_doi)
+                    if fingerprint == previous_fingerprint and not options['force']:
+                        counts[ezid.UPDATE_SKIPPED] += 1
+                        progress.step()
+                        continue
+
+                    pending[preprint.pk] = (preprint, fingerprint, previous_fingerprint)
+                    yield preprint.pk, (ezid_config, ezid_metadata, 'ezid/posted_content.xml')
+
+        def on_result(preprint_pk, ezid_result, error):
+            preprint, fingerprint, previous_fingerprint = pending.pop(preprint_pk)
+            progress.step()
+            if error is None and isinstance(ezid_result, str) and ezid_result.startswith('success:'):
+                ezid.save_payload_fingerprint(preprint.preprint_doi, fingerprint)
+                counts[ezid.UPDATE_CHANGED if previous_fingerprint else ezid.UPDATE_SENT] += 1
+            else:
+                failures.append((preprint_pk, str(error or ezid_result).strip()))
+                ezid.record_ezid_failure(EZIDOutbox.ACTION_UPDATE, error or ezid_result, preprint=preprint)
+
+        start = time.monotonic()
+        if options['use_async']:
+            aio.run_concurrently(tasks(), aio.update_doi_via_ezid, on_result,
+                                 concurrency=options['concurrency'], rate=options['rate'], batch_size=options['batch_size'])
+        else:
+            bulk.run_concurrently(tasks(), ezid.update_doi_via_ezid, on_result,
+                                  concurrency=options['concurrency'], rate=options['rate'])
+        elapsed = time.monotonic() - start
+
+        self.stdout.write("Done in {}: sent {} (changed {}), skipped {}, {} failures.".format(
+            bulk.format_duration(elapsed), counts[ezid.UPDATE_SENT] + counts[ezid.UPDATE_CHANGED],
+            counts[ezid.UPDATE_CHANGED], counts[ezid.UPDATE_SKIPPED], len(failures)))
+        for preprint_pk, message in failures:
+            self.stdout.write(self.style.ERROR('EZID DOI update failed for preprint.pk: {} ... {}'.format(preprint_pk, message)))
+        metrics.write_summary(self.stdout.write)
+
+    def filter_preprints(self, repo, options):
+        preprints = models.Preprint.objects.filter(
+            repository=repo,
+            stage='preprint_published',
+            date_published__lte=timezone.now(),
+        ).exclude(
+            preprint_doi__isnull=True,
+        ).exclude(
+            preprint_doi='',
+        )
+
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--since must be a date in YYYY-MM-DD format')
+            preprints = preprints.filter(date_updated__gte=timezone.make_aware(since))
+
+        if options['subject']:
+            if options['subject'].isdigit():
+                preprints = preprints.filter(subject__pk=options['subject'])
+            else:
+                preprints = preprints.filter(subject__name=options['subject'])
+
+        if options['owner']:
+            if options['owner'].isdigit():
+                preprints = preprints.filter(owner__pk=options['owner'])
+            else:
+                preprints = preprints.filter(owner__email=options['owner'])
+
+        return preprints.distinct()
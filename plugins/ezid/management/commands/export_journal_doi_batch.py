@@ -0,0 +1,141 @@
+"""
+Janeway Management command for exporting journal article DOI metadata as one multi-article Crossref deposit
+"""
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from submission.models import Article
+from plugins.ezid import bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+from plugins.ezid import preflight
+
+class Command(BaseCommand):
+    """ Streams a journal's articles into a single doi_batch file, and optionally registers their DOIs via EZID """
+    help = "Writes one Crossref doi_batch deposit for many journal articles, and/or registers their DOIs in one run."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--journal", help="`code` of the journal whose articles to export", type=str, default=None)
+        parser.add_argument(
+            "--issue", help="`id` of the issue whose articles to export", type=int, default=None)
+        parser.add_argument(
+            "--ids", help="range of article ids to export, e.g. 100-250", type=str, default=None)
+        parser.add_argument(
+            "--output", help="path of the doi_batch file to write", type=str, default=None)
+        parser.add_argument(
+            "--push", help="also register each DOI via EZID, which takes one DOI per request", action="store_true")
+        parser.add_argument(
+            "--concurrency", help="number of EZID requests in flight at once with --push", type=int, default=4)
+        parser.add_argument(
+            "--rate", help="maximum number of EZID requests per second, unlimited if omitted", type=float, default=None)
+        parser.add_argument(
+            "--batch-size", help="number of articles loaded per query", type=int, default=200)
+
+    def handle(self, *args, **options):
+        if not options['output'] and not options['push']:
+            raise CommandError('Nothing to do, pass --output and/or --push.')
+
+        articles = self.filter_articles(options)
+        if options['output'] and articles.values('journal').distinct().count() > 1:
+            # a doi_batch has a single depositor and registrant
+            raise CommandError('The selected articles belong to more than one journal, export one journal at a time.')
+
+        total = articles.count()
+        self.stdout.write("Exporting DOI metadata for {} articles...".format(total))
+        progress = bulk.Progress(total, self.stdout.write)
+        now = timezone.now()
+
+        self.registered = []
+        self.failures = []
+        self.skipped = []
+        self.pending = {}
+        out = open(options['output'], 'w', encoding='UTF-8') if options['output'] else None
+
+        def tasks():
+            for batch in bulk.stream_queryset_batches(articles, options['batch_size']):
+                for article in batch:
+                    ezid_config, ezid_metadata = ezid.get_journal_metadata(article)
+                    if not ezid_metadata['doi']:
+                        self.skipped.append(article.pk)
+                        progress.step()
+                        continue
+                    ezid_metadata['now'] = now
+
+                    if out is not None:
+                        if out.tell() == 0:
+                            out.write(ezid.get_crossref_template('ezid/journal_batch_head.xml').render(dict(
+                                ezid_metadata, batch_id='{}_{}_batch'.format(article.journal.name.replace(' ', ''), now.strftime('%Y%m%d')))))
+                        out.write('        ' + ezid.render_journal_article(ezid_metadata) + '\n')
+
+                    if not options['push']:
+                        progress.step()
+                        continue
+                    # the template reads the article's relations, so the payload is rendered here, in the
+                    # calling thread, and the pool threads only send it
+                    fingerprint = ezid.payload_fingerprint(ezid_config, ezid_metadata, 'ezid/journal_content.xml')
+                    try:
+                        payload = ezid.build_ezid_payload(ezid_config, ezid_metadata, 'ezid/journal_content.xml',
+                                                          check_schema=preflight.is_enabled())
+                    except preflight.PreflightError as error:
+                        self.pending[article.pk] = (article, ezid_metadata, fingerprint)
+                        on_result(article.pk, error.as_result(), None)
+                        continue
+                    self.pending[article.pk] = (article, ezid_metadata, fingerprint)
+                    yield article.pk, (payload, ezid_metadata['doi'], ezid_config['username'],
+                                       ezid_config['password'], ezid_config['endpoint_url'])
+
+        def on_result(article_pk, ezid_result, error):
+            article, ezid_metadata, fingerprint = self.pending.pop(article_pk)
+            progress.step()
+            success, ezid_result = ezid.finish_journal_registration(article, ezid_metadata, fingerprint, error or ezid_result)
+            if success:
+                self.registered.append(ezid_metadata['doi'])
+            else:
+                self.failures.append((article_pk, str(ezid_result).strip()))
+
+        start = time.monotonic()
+        try:
+            if options['push']:
+                bulk.run_concurrently(tasks(), ezid.send_create_request, on_result,
+                                      concurrency=options['concurrency'], rate=options['rate'])
+            else:
+                for _ in tasks():
+                    pass
+            if out is not None and out.tell():
+                out.write(ezid.JOURNAL_BATCH_TAIL)
+        finally:
+            if out is not None:
+                out.close()
+        elapsed = time.monotonic() - start
+
+        if out is not None:
+            self.stdout.write("Wrote {} article records to {}.".format(total - len(self.skipped), options['output']))
+        if options['push']:
+            self.stdout.write("Registered {} DOIs in {}, {} failures.".format(
+                len(self.registered), bulk.format_duration(elapsed), len(self.failures)))
+        for article_pk in self.skipped:
+            self.stdout.write(self.style.WARNING('Article {} has no DOI, skipped.'.format(article_pk)))
+        for article_pk, message in self.failures:
+            self.stdout.write(self.style.ERROR('EZID DOI creation failed for article.pk: {} ... {}'.format(article_pk, message)))
+        metrics.write_summary(self.stdout.write)
+
+    def filter_articles(self, options):
+        articles = Article.objects.filter(date_published__isnull=False).select_related('journal')
+
+        if not (options['journal'] or options['issue'] or options['ids']):
+            raise CommandError('Select the articles with --journal, --issue and/or --ids.')
+        if options['journal']:
+            articles = articles.filter(journal__code=options['journal'])
+        if options['issue']:
+            articles = articles.filter(issues__pk=options['issue'])
+        if options['ids']:
+            try:
+                first, last = (int(article_id) for article_id in options['ids'].split('-'))
+            except ValueError:
+                raise CommandError('--ids must be a range of article ids, e.g. 100-250')
+            articles = articles.filter(pk__gte=first, pk__lte=last)
+
+        return articles.distinct()
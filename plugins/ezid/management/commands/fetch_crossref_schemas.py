@@ -0,0 +1,70 @@
+"""
+Janeway Management command for downloading the Crossref schemas the EZID preflight check validates against
+"""
+
+import os
+import posixpath
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urljoin, urlparse
+
+from django.core.management.base import BaseCommand, CommandError
+
+from plugins.ezid import preflight
+
+XSD_NAMESPACE = '{http://www.w3.org/2001/XMLSchema}'
+DEFAULT_BASE_URL = 'https://data.crossref.org/schemas/'
+
+class Command(BaseCommand):
+    """ Downloads the Crossref deposit schemas of the plugin's templates, and every schema they import, into the schema directory """
+    help = "Downloads the Crossref XSDs used by EZID_PREFLIGHT and validate_ezid_payloads."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--base-url", help="where the Crossref schemas are published", type=str, default=DEFAULT_BASE_URL)
+        parser.add_argument(
+            "--dir", help="directory to write them to, EZID_SCHEMA_DIR or the plugin's schemas directory if omitted",
+            type=str, default=None)
+
+    def handle(self, *args, **options):
+        base_url = options['base_url'].rstrip('/') + '/'
+        schema_dir = options['dir'] or preflight.get_schema_dir()
+
+        # imports are followed with the same relative paths, so lxml resolves them from the files on disk
+        queue = sorted(set(preflight.SCHEMA_FILES.values()))
+        fetched = set()
+        while queue:
+            name = queue.pop(0)
+            if name in fetched:
+                continue
+            fetched.add(name)
+
+            url = urljoin(base_url, name)
+            self.stdout.write("Fetching {}".format(url))
+            try:
+                with urllib.request.urlopen(url, timeout=60) as resp:
+                    body = resp.read()
+            except OSError as error:
+                raise CommandError('Cannot download {}: {}'.format(url, error))
+
+            path = os.path.join(schema_dir, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(body)
+
+            for location in schema_locations(body):
+                if urlparse(location).scheme:
+                    # absolute locations (e.g. the W3C xml.xsd) are left to lxml
+                    continue
+                imported = posixpath.normpath(posixpath.join(posixpath.dirname(name), location))
+                if imported.startswith('../'):
+                    raise CommandError('{} imports {}, outside of {}'.format(name, location, base_url))
+                queue.append(imported)
+
+        self.stdout.write(self.style.SUCCESS("{} schema files written to {}".format(len(fetched), schema_dir)))
+
+def schema_locations(body):
+    ''' returns the schemaLocation of every xs:include, xs:import and xs:redefine in an XSD '''
+    root = ElementTree.fromstring(body)
+    return [element.get('schemaLocation') for tag in ('include', 'import', 'redefine')
+            for element in root.iter(XSD_NAMESPACE + tag) if element.get('schemaLocation')]
@@ -0,0 +1,88 @@
+"""
+Janeway Management command for draining the EZID job queue
+"""
+
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from plugins.ezid import bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+
+class Command(BaseCommand):
+    """ Runs the queued EZID mint and update jobs, retrying failures with exponential backoff """
+    help = "Processes pending EZID jobs queued by the preprint publication hook."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", help="number of EZID requests in flight at once", type=int, default=4)
+        parser.add_argument(
+            "--batch-size", help="number of jobs claimed from the queue at a time", type=int, default=50)
+        parser.add_argument(
+            "--max-attempts", help="attempts before a job is moved to the dead state", type=int, default=8)
+        parser.add_argument(
+            "--loop", help="keep polling the queue instead of exiting once it is empty", action="store_true")
+        parser.add_argument(
+            "--sleep", help="seconds to wait between polls when looping", type=int, default=10)
+        parser.add_argument(
+            "--stale-after", help="minutes after which a running job is assumed abandoned and requeued", type=int, default=30)
+
+    def handle(self, *args, **options):
+
+        requeued = ezid.requeue_stale_ezid_jobs(timedelta(minutes=options['stale_after']))
+        if requeued:
+            self.stdout.write("Requeued {} abandoned jobs.".format(requeued))
+
+        while True:
+            processed = self.drain(options)
+            if processed:
+                ezid.share_http_latency()
+                self.stdout.write("Processed {} jobs.".format(processed))
+                if options['loop']:
+                    metrics.log_summary()
+            if not options['loop']:
+                metrics.write_summary(self.stdout.write)
+                break
+            if not processed:
+                time.sleep(options['sleep'])
+
+    def drain(self, options):
+        ''' runs due jobs until none are left, returns the number of jobs processed '''
+        processed = 0
+        while True:
+            jobs = ezid.claim_ezid_jobs(options['batch_size'])
+            if not jobs:
+                return processed
+            processed += len(jobs)
+
+            job_by_pk = {job.pk: job for job in jobs}
+            args_by_pk = {}
+
+            def tasks():
+                for job in jobs:
+                    try:
+                        prepared = ezid.prepare_ezid_job(job)
+                    except Exception as error:
+                        ezid.fail_ezid_job(job, 'unable to gather metadata: {}'.format(error), max_attempts=options['max_attempts'])
+                        continue
+                    if prepared is None:
+                        # minted some other way since it was queued, or the metadata EZID has is current
+                        job.status = job.STATUS_DONE
+                        job.save()
+                        continue
+                    send, send_args = prepared
+                    args_by_pk[job.pk] = send_args
+                    yield job.pk, (send, send_args)
+
+            def on_result(job_pk, ezid_result, error):
+                job = job_by_pk[job_pk]
+                send_args = args_by_pk.pop(job_pk)
+                if error is not None:
+                    ezid.fail_ezid_job(job, error, max_attempts=options['max_attempts'])
+                elif ezid.finish_ezid_job(job, ezid_result, max_attempts=options['max_attempts'], send_args=send_args):
+                    self.stdout.write(self.style.SUCCESS('EZID {} job for preprint {} done'.format(job.action, job.preprint_id)))
+                elif job.status == job.STATUS_DEAD:
+                    self.stdout.write(self.style.ERROR('EZID {} job for preprint {} is dead: {}'.format(job.action, job.preprint_id, job.last_error)))
+
+            bulk.run_concurrently(tasks(), lambda send, send_args: send(*send_args), on_result,
+                                  concurrency=options['concurrency'])
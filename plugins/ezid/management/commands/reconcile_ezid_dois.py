@@ -0,0 +1,121 @@
+"""
+Janeway Management command for finding preprint DOIs whose EZID record has drifted from Janeway
+"""
+
+import csv
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from plugins.ezid import bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+from plugins.ezid.models import EZIDJob
+from repository import models
+
+REPORT_FIELDS = ('preprint_id', 'doi', 'field', 'janeway', 'ezid')
+
+class Command(BaseCommand):
+    """ Fetches the EZID record of every preprint DOI in a repository and compares it with the metadata Janeway would send """
+    help = "Reports preprint DOIs whose EZID target URL, title or authors differ from Janeway, optionally queueing updates."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "short_name", help="`short_name` for the repository containing the preprints to check", type=str)
+        parser.add_argument(
+            "--report", help="path of the CSV diff report, ezid_reconcile_<short_name>.csv if omitted", type=str, default=None)
+        parser.add_argument(
+            "--fix", help="queue an EZID update for every DOI that differs", action="store_true")
+        parser.add_argument(
+            "--concurrency", help="number of EZID requests in flight at once", type=int, default=4)
+        parser.add_argument(
+            "--rate", help="maximum number of EZID requests per second, unlimited if omitted", type=float, default=None)
+        parser.add_argument(
+            "--batch-size", help="number of preprints loaded per query", type=int, default=500)
+
+    def handle(self, *args, **options):
+
+        short_name = options.get('short_name')
+
+        try:
+            repo = models.Repository.objects.get(
+                short_name=short_name,
+            )
+        except models.Repository.DoesNotExist:
+            exit('No repository found.')
+
+        preprints = models.Preprint.objects.filter(
+            repository=repo,
+            stage='preprint_published',
+            date_published__lte=timezone.now(),
+        ).exclude(
+            preprint_doi__isnull=True,
+        ).exclude(
+            preprint_doi='',
+        )
+        ezid_config = ezid.get_ezid_config(repo)
+        # DOIs outside the repository's shoulder (e.g. imported from OSF) have no EZID record to compare
+        ezid_preprints = ezid.filter_ezid_dois(preprints, ezid_config)
+        foreign = preprints.count() - ezid_preprints.count()
+        preprints = ezid_preprints
+        ezid.reserve_ezid_connections(ezid_config, options['concurrency'])
+
+        total = preprints.count()
+        self.stdout.write("Reconciling {} preprint DOIs with EZID...".format(total))
+        progress = bulk.Progress(total, self.stdout.write)
+
+        report_path = options['report'] or 'ezid_reconcile_{}.csv'.format(short_name)
+        report_file = open(report_path, 'w', newline='', encoding='UTF-8')
+        report = csv.writer(report_file)
+        report.writerow(REPORT_FIELDS)
+
+        counts = {'in_sync': 0, 'divergent': 0, 'errors': 0, 'queued': 0}
+        pending = {}
+
+        def tasks():
+            for batch in ezid.preprint_metadata_batches(preprints, options['batch_size']):
+                for preprint, ezid_metadata in batch:
+                    if ezid_metadata is None:
+                        counts['errors'] += 1
+                        report.writerow((preprint.pk, preprint.preprint_doi, 'metadata', 'unable to gather metadata', ''))
+                        progress.step()
+                        continue
+                    ezid_metadata['update_id'] = preprint.preprint_doi
+                    ezid.validate_published_doi(ezid_metadata)
+                    pending[preprint.pk] = (preprint, ezid_metadata)
+                    yield preprint.pk, (ezid_config, preprint.preprint_doi)
+
+        def on_result(preprint_pk, record, error):
+            preprint, ezid_metadata = pending.pop(preprint_pk)
+            progress.step()
+            if error is not None or not isinstance(record, dict):
+                counts['errors'] += 1
+                report.writerow((preprint_pk, preprint.preprint_doi, 'record', '', str(error or record).strip()))
+                return
+
+            differences = ezid.compare_ezid_record(ezid_metadata, 'ezid/posted_content.xml', record)
+            if not differences:
+                counts['in_sync'] += 1
+                return
+
+            counts['divergent'] += 1
+            for field, janeway_value, ezid_value in differences:
+                report.writerow((preprint_pk, preprint.preprint_doi, field, janeway_value, ezid_value))
+            if options['fix']:
+                # the stored fingerprint no longer describes what EZID holds, so the update must not be skipped
+                ezid.forget_payload_fingerprint(preprint.preprint_doi)
+                ezid.enqueue_preprint_job(preprint, EZIDJob.ACTION_UPDATE)
+                counts['queued'] += 1
+
+        start = time.monotonic()
+        try:
+            bulk.run_concurrently(tasks(), ezid.get_ezid_record, on_result,
+                                  concurrency=options['concurrency'], rate=options['rate'])
+        finally:
+            report_file.close()
+        elapsed = time.monotonic() - start
+
+        self.stdout.write("Done in {}: {} in sync, {} divergent, {} errors, {} updates queued. Report written to {}.".format(
+            bulk.format_duration(elapsed), counts['in_sync'], counts['divergent'], counts['errors'], counts['queued'], report_path))
+        if foreign:
+            self.stdout.write("{} preprints were not checked, their DOI is outside the {} shoulder.".format(foreign, ezid_config['shoulder']))
+        metrics.write_summary(self.stdout.write)
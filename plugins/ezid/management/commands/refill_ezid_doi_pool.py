@@ -0,0 +1,56 @@
+"""
+Janeway Management command for topping up the pools of reserved EZID DOIs
+"""
+
+from django.core.management.base import BaseCommand
+from plugins.ezid import bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+from plugins.ezid.models import RepoEZIDSettings, EZIDReservedDOI
+
+class Command(BaseCommand):
+    """ Mints reserved DOIs for every repository whose pool has fallen below its low-water mark """
+    help = "Refills the pools of reserved DOIs claimed at publication time."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "short_name", help="only refill the pool of the repository with this `short_name`", type=str, nargs='?')
+        parser.add_argument(
+            "--concurrency", help="number of reservation requests in flight at once", type=int, default=4)
+
+    def handle(self, *args, **options):
+
+        all_settings = RepoEZIDSettings.objects.filter(ezid_doi_pool_size__gt=0).select_related('repo')
+        if options['short_name']:
+            all_settings = all_settings.filter(repo__short_name=options['short_name'])
+
+        for ezid_settings in all_settings:
+            available = ezid.reserved_doi_pool_stats(ezid_settings)
+            if available >= ezid_settings.ezid_doi_pool_low_water:
+                self.stdout.write("{}: {} reserved DOIs available, nothing to do.".format(ezid_settings.repo, available))
+                continue
+
+            wanted = ezid_settings.ezid_doi_pool_size - available
+            self.stdout.write("{}: {} reserved DOIs available, reserving {} more...".format(ezid_settings.repo, available, wanted))
+
+            ezid_config = ezid.get_ezid_config(ezid_settings.repo)
+            ezid.reserve_ezid_connections(ezid_config, options['concurrency'])
+            # reserved DOIs point at the repository until they are claimed and published
+            target_url = ezid.get_repository_url(ezid_settings.repo)
+            reserved = []
+
+            def on_result(_, doi, error):
+                if error is None and doi:
+                    EZIDReservedDOI.objects.create(ezid_settings=ezid_settings, doi=doi)
+                    reserved.append(doi)
+
+            tasks = ((i, (ezid_config, target_url)) for i in range(wanted))
+            bulk.run_concurrently(tasks, ezid.reserve_doi_via_ezid, on_result, concurrency=options['concurrency'])
+
+            message = "{}: reserved {} of {} DOIs.".format(ezid_settings.repo, len(reserved), wanted)
+            if len(reserved) < wanted:
+                self.stdout.write(self.style.ERROR(message))
+            else:
+                self.stdout.write(self.style.SUCCESS(message))
+
+        metrics.write_summary(self.stdout.write)
@@ -2,15 +2,12 @@
 Janeway Management command for registering DOIs for the EZID plugin
 """
 
-import re
 from django.core.management.base import BaseCommand
 from plugins.ezid import logic as ezid
+from plugins.ezid.models import EZIDOutbox
 from repository import models
-from press import models as press_models
 # import pdb #uncomment this for troubleshooting
 
-from plugins.ezid.models import RepoEZIDSettings
-
 class Command(BaseCommand):
     """ Takes a preprint ID and mints a DOI via EZID, if the DOI is not yet minted, AND if the preprint is accepted """
     help = "Mints a DOI for the provided preprint ID."
@@ -50,57 +47,20 @@ class Command(BaseCommand):
             raise RuntimeError("Preprint " + preprint_id + " is not yet published, cannot mint a DOI for an unpublished preprint.")
 
         # gather metadata required for minting a DOI via EZID
-        # site_url = repo.site_url()
-        # target_url = site_url + preprint.local_url
-
-        try:
-            target_url = repo.site_url(preprint.local_url)
-        except AttributeError:
-            # let's just grab the first Press object and hope
-            first_press = press_models.Press.get_press(None)
-            target_url = first_press.repository_path_url(repo, preprint.local_url)
-
-        group_title = preprint.subject.values_list()[0][2]
-        title = preprint.title.replace('%', '%25')
-        abstract = preprint.abstract.replace('%', '%25')
-        published_doi = preprint.doi
-        accepted_date = {'month':preprint.date_accepted.month, 'day':preprint.date_accepted.day, 'year':preprint.date_accepted.year}
-        published_date = {'month':preprint.date_published.month, 'day':preprint.date_published.day, 'year':preprint.date_published.year}
-
-        contributors = ezid.normalize_author_metadata(preprint.preprintauthor_set.all())
+        ezid_config = ezid.get_ezid_config(repo)
+        ezid_metadata = ezid.get_preprint_metadata(preprint)
 
         #debug breakpoint, use to confirm the metadata gathered above
         # pdb.set_trace()
 
-        ezid_settings = RepoEZIDSettings.objects.get(repo=repo)
-
-        ezid_config = {'shoulder': ezid_settings.ezid_shoulder,
-                       'username': ezid_settings.ezid_username,
-                       'password': ezid_settings.ezid_password,
-                       'endpoint_url': ezid_settings.ezid_endpoint_url,
-                       'owner': ezid_settings.ezid_owner}
-        ezid_metadata = {'target_url': target_url,
-                         'group_title': group_title,
-                         'contributors': contributors,
-                         'title': title,
-                         'abstract': abstract,
-                         'published_doi': published_doi,
-                         'published_date': published_date,
-                         'accepted_date': accepted_date}
-
         ezid_result = ezid.mint_doi_via_ezid(ezid_config, ezid_metadata, 'ezid/posted_content.xml')
 
-        # if the ezid_result is a string, it's probably a success, check to be sure
-        if isinstance(ezid_result, str):
-            if ezid_result.startswith('success:'):
-                new_doi = re.search("doi:([0-9A-Z./]+)", ezid_result).group(1)
-                self.stdout.write(self.style.SUCCESS('DOI successfully created: ' + new_doi))
-                preprint.preprint_doi = new_doi
-                preprint.save()
-                self.stdout.write(self.style.SUCCESS('✅ DOI added to preprint Janeway object and saved.'))
-            else:
-                self.stdout.write(self.style.ERROR('EZID DOI creation failed for preprint.pk: ' + preprint.pk + ' ...'))
-                self.stdout.write(self.style.ERROR('ezid_result: ' + ezid_result))
+        new_doi = ezid.save_minted_doi(preprint, ezid_result)
+        if new_doi:
+            self.stdout.write(self.style.SUCCESS('DOI successfully created: ' + new_doi))
+            self.stdout.write(self.style.SUCCESS('✅ DOI added to preprint Janeway object and saved.'))
+            ezid.resolve_ezid_failures(EZIDOutbox.ACTION_MINT, preprint=preprint)
         else:
-            self.stdout.write(self.style.ERROR('EZID DOI creation failed for preprint.pk: ' + str(preprint.pk) + ' ...'))
-            self.stdout.write(self.style.ERROR(ezid_result.msg))
+            self.stdout.write(self.style.ERROR('EZID DOI creation failed for preprint.pk: {} ...'.format(preprint.pk)))
+            self.stdout.write(self.style.ERROR('ezid_result: {}'.format(ezid_result)))
+            ezid.record_ezid_failure(EZIDOutbox.ACTION_MINT, ezid_result, preprint=preprint)
@@ -5,18 +5,18 @@ from submission.models import Article
 from plugins.ezid import logic
 
 class Command(BaseCommand):
-    """ Takes a journal article ID and mints a DOI via EZID, if the DOI is not yet minted"""
-    help = "Mints a DOI for the provided article ID."
+    """ Takes journal article IDs and mints DOIs via EZID, if the DOIs are not yet minted"""
+    help = "Mints DOIs for the provided article IDs."
 
     def add_arguments(self, parser):
         parser.add_argument(
-            "article_id", help="`id` of article needing a DOI to be minted", type=int
+            "article_id", help="`id` of article(s) needing a DOI to be minted", type=int, nargs='+'
         )
 
     def handle(self, *args, **options):
-        article_id = options['article_id']
+        articles = Article.objects.filter(id__in=options['article_id']).select_related('journal').order_by('journal', 'id')
 
-        self.stdout.write("Attempting to mint a DOI for article_id={}".format(article_id))
-
-        article = Article.objects.get(id=article_id)
-        logic.register_journal_doi(article)
\ No newline at end of file
+        for article in articles:
+            self.stdout.write("Attempting to mint a DOI for article_id={}".format(article.pk))
+            # the journal's Crossref settings are cached, so only the first article of each journal reads them
+            logic.register_journal_doi(article)
@@ -0,0 +1,113 @@
+"""
+Janeway Management command for replaying failed EZID requests from the outbox
+"""
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from plugins.ezid import bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+from plugins.ezid.models import EZIDOutbox
+
+class Command(BaseCommand):
+    """ Sends every unresolved outbox entry to EZID again, once EZID reports that it is up """
+    help = "Replays EZID requests that failed permanently."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--action", help="only replay entries for this action", type=str, choices=[choice[0] for choice in EZIDOutbox.ACTION_CHOICES])
+        parser.add_argument(
+            "--limit", help="replay at most this many entries", type=int, default=None)
+        parser.add_argument(
+            "--concurrency", help="number of preprint requests in flight at once", type=int, default=4)
+
+    def handle(self, *args, **options):
+
+        entries = EZIDOutbox.objects.filter(resolved=False).select_related(
+            'preprint', 'preprint__repository', 'article', 'article__journal',
+        ).order_by('pk')
+        if options['action']:
+            entries = entries.filter(action=options['action'])
+        if options['limit']:
+            entries = entries[:options['limit']]
+        entries = list(entries)
+
+        self.stdout.write("Replaying {} EZID outbox entries...".format(len(entries)))
+        self.healthy = {}
+        self.replayed = self.resolved = 0
+
+        preprint_entries = [entry for entry in entries if entry.preprint_id]
+        ezid.prefetch_preprint_metadata([entry.preprint for entry in preprint_entries])
+        self.replay_preprint_entries(preprint_entries, options['concurrency'])
+
+        for entry in entries:
+            if entry.article_id:
+                self.replay_article_entry(entry)
+
+        self.stdout.write("Replayed {}, resolved {}, {} left in the outbox.".format(
+            self.replayed, self.resolved, EZIDOutbox.objects.filter(resolved=False).count()))
+        metrics.write_summary(self.stdout.write)
+
+    def ezid_is_healthy(self, ezid_config):
+        ''' checks each endpoint once per run, and skips it for the rest of the run if its circuit opens '''
+        endpoint_url = ezid_config['endpoint_url']
+        if endpoint_url not in self.healthy:
+            self.healthy[endpoint_url] = ezid.ezid_is_up(ezid_config)
+            if not self.healthy[endpoint_url]:
+                self.stdout.write(self.style.ERROR("EZID at {} is not up, skipping its entries.".format(endpoint_url)))
+        return self.healthy[endpoint_url] and not ezid.ezid_circuit_open(ezid_config)
+
+    def record(self, entry, succeeded, ezid_result):
+        self.replayed += 1
+        entry.replays += 1
+        entry.date_replayed = timezone.now()
+        if succeeded:
+            self.resolved += 1
+            entry.resolved = True
+            self.stdout.write(self.style.SUCCESS("{} replayed".format(entry)))
+        else:
+            entry.error = str(ezid_result)
+            self.stdout.write(self.style.ERROR("{} failed again: {}".format(entry, ezid_result)))
+        entry.save()
+
+    def replay_preprint_entries(self, entries, concurrency):
+        entry_by_pk = {entry.pk: entry for entry in entries}
+        args_by_pk = {}
+
+        def tasks():
+            for entry in entries:
+                try:
+                    # what EZID holds after a failure is unknown, so the update is sent even if it looks unchanged
+                    prepared = ezid.prepare_preprint_action(entry.preprint, entry.action, force=True)
+                except (IndexError, AttributeError) as error:
+                    self.record(entry, False, 'unable to gather metadata: {}'.format(error))
+                    continue
+                if prepared is None:
+                    # the preprint got its DOI some other way, or EZID already has the current metadata
+                    self.record(entry, True, None)
+                    continue
+                send, send_args = prepared
+                if not self.ezid_is_healthy(send_args[0]):
+                    continue
+                args_by_pk[entry.pk] = send_args
+                yield entry.pk, (send, send_args)
+
+        def on_result(entry_pk, ezid_result, error):
+            entry = entry_by_pk[entry_pk]
+            send_args = args_by_pk.pop(entry_pk)
+            succeeded = error is None and ezid.finish_preprint_action(entry.preprint, entry.action, ezid_result, send_args)
+            self.record(entry, succeeded, error or ezid_result)
+
+        bulk.run_concurrently(tasks(), lambda send, send_args: send(*send_args), on_result, concurrency=concurrency)
+
+    def replay_article_entry(self, entry):
+        ezid_config, _ = ezid.get_journal_metadata(entry.article)
+        if not self.ezid_is_healthy(ezid_config):
+            return
+
+        # both calls record a fresh outbox entry on failure, so resolve this one either way
+        if entry.action == EZIDOutbox.ACTION_JOURNAL_CREATE:
+            succeeded, ezid_result = ezid.register_journal_doi(entry.article)
+        else:
+            _, succeeded, ezid_result = ezid.update_journal_doi(entry.article, force=True)
+        self.record(entry, succeeded, ezid_result)
@@ -0,0 +1,115 @@
+"""
+Janeway Management command for pointing every preprint DOI in a repository at a new URL
+"""
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from plugins.ezid import bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics
+from plugins.ezid.models import EZIDOutbox
+from repository import models
+
+class Command(BaseCommand):
+    """ Sends target-only updates for the preprint DOIs of a repository, without re-sending their crossref metadata """
+    help = "Updates the _target of every preprint DOI in the repository, e.g. after a URL scheme or domain change."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "short_name", help="`short_name` for the repository containing the preprints to retarget", type=str)
+        parser.add_argument(
+            "--mapped-only", help="only send the DOIs whose target EZID_TARGET_URL_MAPPING rewrites", action="store_true")
+        parser.add_argument(
+            "--dry-run", help="print the new targets instead of sending them", action="store_true")
+        parser.add_argument(
+            "--concurrency", help="number of update requests in flight at once", type=int, default=8)
+        parser.add_argument(
+            "--rate", help="maximum number of update requests per second, unlimited if omitted", type=float, default=None)
+        parser.add_argument(
+            "--batch-size", help="number of preprints loaded per query", type=int, default=2000)
+
+    def handle(self, *args, **options):
+
+        short_name = options.get('short_name')
+
+        try:
+            repo = models.Repository.objects.get(
+                short_name=short_name,
+            )
+        except models.Repository.DoesNotExist:
+            exit('No repository found.')
+
+        mapping = ezid.get_target_url_mapping()
+        if options['mapped_only'] and not mapping:
+            raise CommandError('--mapped-only needs EZID_TARGET_URL_MAPPING in the settings.')
+
+        preprints = models.Preprint.objects.filter(
+            repository=repo,
+            stage='preprint_published',
+            date_published__lte=timezone.now(),
+        ).exclude(
+            preprint_doi__isnull=True,
+        ).exclude(
+            preprint_doi='',
+        )
+
+        ezid_config = ezid.get_ezid_config(repo)
+        # DOIs outside the repository's shoulder (e.g. imported from OSF) are not this repository's to retarget
+        ezid_preprints = ezid.filter_ezid_dois(preprints, ezid_config)
+        foreign = preprints.count() - ezid_preprints.count()
+        if foreign:
+            self.stdout.write("Skipping {} preprints whose DOI is outside the {} shoulder.".format(foreign, ezid_config['shoulder']))
+        preprints = ezid_preprints
+        ezid.reserve_ezid_connections(ezid_config, options['concurrency'])
+
+        total = preprints.count()
+        self.stdout.write("Retargeting {} preprint DOIs...".format(total))
+        progress = bulk.Progress(total, self.stdout.write)
+        retargeted = []
+        unmapped = []
+        failures = []
+        pending = {}
+
+        def tasks():
+            for preprint in bulk.stream_queryset(preprints, options['batch_size']):
+                # every preprint is in `repo`, reuse it rather than loading the repository per preprint
+                preprint.repository = repo
+                # the URL get_preprint_target_url gives, which every later update sends too, so the migration sticks
+                target_url = ezid.get_repository_url(repo, preprint.local_url)
+                mapped_url = ezid.map_target_url(target_url, mapping)
+                if mapped_url is None and options['mapped_only']:
+                    unmapped.append(preprint.pk)
+                    progress.step()
+                    continue
+                target_url = mapped_url or target_url
+
+                if options['dry_run']:
+                    self.stdout.write('{} {}'.format(preprint.preprint_doi, target_url))
+                    retargeted.append(preprint.preprint_doi)
+                    continue
+
+                pending[preprint.pk] = preprint
+                yield preprint.pk, (ezid_config, preprint.preprint_doi, target_url)
+
+        def on_result(preprint_pk, ezid_result, error):
+            preprint = pending.pop(preprint_pk)
+            progress.step()
+            if error is None and isinstance(ezid_result, str) and ezid_result.startswith('success:'):
+                retargeted.append(preprint.preprint_doi)
+            else:
+                failures.append((preprint_pk, str(error or ezid_result).strip()))
+                # replayed as a target-only update
+                ezid.record_ezid_failure(EZIDOutbox.ACTION_RETARGET, error or ezid_result, preprint=preprint)
+
+        start = time.monotonic()
+        bulk.run_concurrently(tasks(), ezid.retarget_doi_via_ezid, on_result,
+                              concurrency=options['concurrency'], rate=options['rate'])
+        elapsed = time.monotonic() - start
+
+        self.stdout.write("{} {} DOIs in {}, {} without a matching prefix, {} failures.".format(
+            'Would retarget' if options['dry_run'] else 'Retargeted', len(retargeted),
+            bulk.format_duration(elapsed), len(unmapped), len(failures)))
+        for preprint_pk, message in failures:
+            self.stdout.write(self.style.ERROR('EZID DOI retarget failed for preprint.pk: {} ... {}'.format(preprint_pk, message)))
+        metrics.write_summary(self.stdout.write)
@@ -0,0 +1,41 @@
+"""
+Janeway Management command for running the local EZID stand-in server
+"""
+
+from django.core.management.base import BaseCommand
+from plugins.ezid.fake_ezid import FakeEZIDServer, PASSWORD, SHOULDER, USERNAME
+
+class Command(BaseCommand):
+    """ Serves an in-memory EZID on a local port, for load testing the plugin without touching EZID """
+    help = "Runs a fake EZID server until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--host", help="address to listen on", type=str, default='127.0.0.1')
+        parser.add_argument(
+            "--port", help="port to listen on", type=int, default=8765)
+        parser.add_argument(
+            "--username", help="username the server accepts", type=str, default=USERNAME)
+        parser.add_argument(
+            "--password", help="password the server accepts", type=str, default=PASSWORD)
+        parser.add_argument(
+            "--latency", help="simulated EZID processing time per request, in milliseconds", type=int, default=0)
+        parser.add_argument(
+            "--error-rate", help="fraction of requests answered with --error-status", type=float, default=0)
+        parser.add_argument(
+            "--error-status", help="HTTP status of injected errors", type=int, default=500)
+
+    def handle(self, *args, **options):
+        server = FakeEZIDServer(
+            host=options['host'], port=options['port'],
+            username=options['username'], password=options['password'],
+            latency=options['latency'] / 1000, error_rate=options['error_rate'], error_status=options['error_status'],
+        )
+
+        self.stdout.write("Fake EZID listening on http://{}:{} (user {}, shoulder {}), Ctrl-C to stop.".format(
+            options['host'], options['port'], options['username'], SHOULDER))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write("{} requests served, {} identifiers stored.".format(server.requests, len(server.identifiers)))
@@ -6,12 +6,10 @@ import re
 from urllib.parse import urlparse
 from django.core.management.base import BaseCommand
 from plugins.ezid import logic as ezid
+from plugins.ezid.models import EZIDOutbox
 from repository import models
-from press import models as press_models
 # import pdb #uncomment this for troubleshooting
 
-from plugins.ezid.models import RepoEZIDSettings
-
 class Command(BaseCommand):
     """ Takes a preprint ID or DOI URL and updates the associated DOI metadata via EZID, if the preprint has a DOI, AND if the preprint is accepted """
     help = "Updates the DOI metadata for the provided preprint ID."
@@ -22,6 +20,8 @@ class Command(BaseCommand):
         parser.add_argument(
             "preprint_id", help="`id` of preprint needing a DOI to be minted, OR a complete DOI URL", type=str
         )
+        parser.add_argument(
+            "--force", help="send the update even if the metadata matches the last deposit", action="store_true")
 
     def handle(self, *args, **options):
 
@@ -72,60 +72,26 @@ class Command(BaseCommand):
         #debug breakpoint, use to inspect the preprint object
         # pdb.set_trace()
 
-        # gather metadata required for minting a DOI via EZID
-        # site_url = repo.site_url()
-        # target_url = site_url + preprint.local_url
-
-        try:
-            target_url = repo.site_url(preprint.local_url)
-        except AttributeError:
-            # let's just grab the first Press object and hope
-            first_press = press_models.Press.get_press(None)
-            target_url = first_press.repository_path_url(repo, preprint.local_url)
-
-        # target_url = repo.site_url(preprint.local_url)
-
-        #debug breakpoint
-        # pdb.set_trace()
-
-        group_title = preprint.subject.values_list()[0][2]
-        title = preprint.title.replace('%', '%25')
-        abstract = preprint.abstract.replace('%', '%25')
-        published_doi = preprint.doi
-        accepted_date = {'month':preprint.date_accepted.month, 'day':preprint.date_accepted.day, 'year':preprint.date_accepted.year}
-        published_date = {'month':preprint.date_published.month, 'day':preprint.date_published.day, 'year':preprint.date_published.year}
-        contributors = ezid.normalize_author_metadata(preprint.preprintauthor_set.all())
+        # gather metadata required for updating a DOI via EZID
+        ezid_config = ezid.get_ezid_config(repo)
+        ezid_metadata = ezid.get_preprint_metadata(preprint)
+        ezid_metadata['update_id'] = preprint.preprint_doi
 
         #debug breakpoint, use to confirm the metadata gathered above
         # pdb.set_trace()
 
-        ezid_settings = RepoEZIDSettings.objects.get(repo=repo)
-
-        ezid_config = {'shoulder': ezid_settings.ezid_shoulder,
-                       'username': ezid_settings.ezid_username,
-                       'password': ezid_settings.ezid_password,
-                       'endpoint_url': ezid_settings.ezid_endpoint_url,
-                       'owner': ezid_settings.ezid_owner}
-        ezid_metadata = {'update_id': preprint.preprint_doi,
-                         'target_url': target_url,
-                         'group_title': group_title,
-                         'contributors': contributors,
-                         'title': title,
-                         'abstract': abstract,
-                         'published_doi': published_doi,
-                         'published_date': published_date,
-                         'accepted_date': accepted_date}
-
-        ezid_result = ezid.update_doi_via_ezid(ezid_config, ezid_metadata, 'ezid/posted_content.xml')
-
-        # if the ezid_result is a string, it's probably a success, check to be sure
-        if isinstance(ezid_result, str):
-            if ezid_result.startswith('success:'):
-                updated_doi = re.search("doi:([0-9A-Z./]+)", ezid_result).group(1)
-                self.stdout.write(self.style.SUCCESS('DOI metadata successfully updated: ' + updated_doi))
-            else:
-                self.stdout.write(self.style.ERROR('EZID DOI creation failed for preprint.pk: ' + preprint.pk + ' ...'))
-                self.stdout.write(self.style.ERROR('ezid_result: ' + ezid_result))
+        outcome, ezid_result = ezid.update_doi_if_changed(ezid_config, ezid_metadata, 'ezid/posted_content.xml', force=options['force'])
+
+        if outcome == ezid.UPDATE_SKIPPED:
+            self.stdout.write('DOI metadata unchanged since the last deposit, not sent. Use --force to send it anyway.')
+        elif ezid_result.startswith('success:'):
+            updated_doi = re.search("doi:([0-9A-Z./]+)", ezid_result).group(1)
+            self.stdout.write(self.style.SUCCESS('DOI metadata successfully updated: ' + updated_doi))
+            ezid.resolve_ezid_failures(EZIDOutbox.ACTION_UPDATE, preprint=preprint)
         else:
-            self.stdout.write(self.style.ERROR('EZID DOI creation failed for preprint.pk: ' + preprint.pk + ' ...'))
-            self.stdout.write(self.style.ERROR(ezid_result.msg))
+            self.stdout.write(self.style.ERROR('EZID DOI update failed for preprint.pk: {} ...'.format(preprint.pk)))
+            self.stdout.write(self.style.ERROR('ezid_result: ' + ezid_result))
+            ezid.record_ezid_failure(EZIDOutbox.ACTION_UPDATE, ezid_result, preprint=preprint)
+
+        self.stdout.write('sent: {}, changed: {}, skipped: {}'.format(
+            int(outcome != ezid.UPDATE_SKIPPED), int(outcome == ezid.UPDATE_CHANGED), int(outcome == ezid.UPDATE_SKIPPED)))
@@ -5,18 +5,32 @@ from submission.models import Article
 from plugins.ezid import logic
 
 class Command(BaseCommand):
-    """ Takes a journal article ID and mints a DOI via EZID, if the DOI is not yet minted"""
-    help = "Mints a DOI for the provided article ID."
+    """ Takes journal article IDs and updates their DOI metadata via EZID, unless it is unchanged"""
+    help = "Updates the DOI metadata for the provided article IDs."
 
     def add_arguments(self, parser):
         parser.add_argument(
-            "article_id", help="`id` of article needing a DOI to be minted", type=int
+            "article_id", help="`id` of article(s) needing their DOI metadata updated", type=int, nargs='+'
         )
+        parser.add_argument(
+            "--force", help="send the update even if the metadata matches the last deposit", action="store_true")
 
     def handle(self, *args, **options):
-        article_id = options['article_id']
+        counts = {logic.UPDATE_SENT: 0, logic.UPDATE_CHANGED: 0, logic.UPDATE_SKIPPED: 0}
+        failed = 0
+
+        for article_id in options['article_id']:
+            self.stdout.write("Attempting to update the DOI metadata for article_id={}".format(article_id))
 
-        self.stdout.write("Attempting to mint a DOI for article_id={}".format(article_id))
+            article = Article.objects.get(id=article_id)
+            outcome, success, ezid_result = logic.update_journal_doi(article, force=options['force'])
+            counts[outcome] += 1
+            if outcome == logic.UPDATE_SKIPPED:
+                self.stdout.write('DOI metadata unchanged since the last deposit, not sent. Use --force to send it anyway.')
+            elif not success:
+                failed += 1
+                self.stdout.write(self.style.ERROR('ezid_result: {}'.format(ezid_result)))
 
-        article = Article.objects.get(id=article_id)
-        logic.update_journal_doi(article)
\ No newline at end of file
+        self.stdout.write('sent: {}, changed: {}, skipped: {}, failed: {}'.format(
+            counts[logic.UPDATE_SENT] + counts[logic.UPDATE_CHANGED], counts[logic.UPDATE_CHANGED],
+            counts[logic.UPDATE_SKIPPED], failed))
@@ -0,0 +1,110 @@
+"""
+Janeway Management command for checking rendered EZID payloads against the Crossref schemas, without contacting EZID
+"""
+
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from submission.models import Article
+from plugins.ezid import bulk
+from plugins.ezid import logic as ezid
+from plugins.ezid import metrics, preflight
+from repository import models
+
+class Command(BaseCommand):
+    """ Renders the crossref record of every published preprint in a repository, or article in a journal, and validates it """
+    help = "Validates the Crossref XML the plugin would send for a repository's preprints or a journal's articles."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "short_name", help="`short_name` of the repository to check", type=str, nargs='?')
+        parser.add_argument(
+            "--journal", help="`code` of a journal to check instead of a repository", type=str, default=None)
+        parser.add_argument(
+            "--concurrency", help="number of records rendered and validated at once", type=int, default=4)
+        parser.add_argument(
+            "--batch-size", help="number of records loaded per query", type=int, default=500)
+
+    def handle(self, *args, **options):
+        if bool(options['short_name']) == bool(options['journal']):
+            raise CommandError('Pass either a repository short_name or --journal.')
+
+        template = 'ezid/journal_content.xml' if options['journal'] else 'ezid/posted_content.xml'
+        try:
+            preflight.get_schema(preflight.SCHEMA_FILES[template])
+        except ImproperlyConfigured as error:
+            raise CommandError(str(error))
+
+        self.valid = 0
+        self.invalid = 0
+
+        def validate(crossref_xml):
+            return preflight.validate_crossref(template, crossref_xml)
+
+        def render_and_validate(ezid_metadata):
+            return validate(ezid.render_crossref(template, ezid_metadata))
+
+        if options['journal']:
+            # article templates read the authors from the database, so articles are rendered here, in the main thread
+            label, check = 'article', validate
+            contexts = ((pk, (ezid.render_crossref(template, ezid_metadata),)) for pk, ezid_metadata in self.article_contexts(options))
+        else:
+            # preprint metadata is plain data, so preprints are rendered on the worker threads too
+            label, check = 'preprint', render_and_validate
+            contexts = ((pk, (ezid_metadata,)) for pk, ezid_metadata in self.preprint_contexts(options))
+
+        def on_result(pk, errors, error):
+            if error is not None:
+                errors = ['unable to render: {}'.format(error)]
+            if not errors:
+                self.valid += 1
+                return
+            self.invalid += 1
+            self.stdout.write(self.style.ERROR('{} {}:'.format(label, pk)))
+            for message in errors:
+                self.stdout.write('  ' + message)
+
+        start = time.monotonic()
+        bulk.run_concurrently(contexts, check, on_result, concurrency=options['concurrency'])
+        elapsed = time.monotonic() - start
+
+        self.stdout.write("Checked {} {}s in {}: {} valid, {} invalid.".format(
+            self.valid + self.invalid, label, bulk.format_duration(elapsed), self.valid, self.invalid))
+        metrics.write_summary(self.stdout.write)
+
+    def preprint_contexts(self, options):
+        try:
+            repo = models.Repository.objects.get(short_name=options['short_name'])
+        except models.Repository.DoesNotExist:
+            raise CommandError('No repository found.')
+
+        preprints = models.Preprint.objects.filter(
+            repository=repo,
+            stage='preprint_published',
+            date_published__lte=timezone.now(),
+        )
+        now = timezone.now()
+        for batch in ezid.preprint_metadata_batches(preprints, options['batch_size']):
+            for preprint, ezid_metadata in batch:
+                if ezid_metadata is None:
+                    self.invalid += 1
+                    self.stdout.write(self.style.ERROR('preprint {}: unable to gather metadata'.format(preprint.pk)))
+                    continue
+                if preprint.preprint_doi:
+                    ezid_metadata['update_id'] = preprint.preprint_doi
+                ezid.validate_published_doi(ezid_metadata)
+                ezid_metadata['now'] = now
+                yield preprint.pk, ezid_metadata
+
+    def article_contexts(self, options):
+        articles = Article.objects.filter(
+            journal__code=options['journal'],
+            date_published__isnull=False,
+        ).select_related('journal')
+        now = timezone.now()
+        for article in bulk.stream_queryset(articles, options['batch_size']):
+            _, ezid_metadata = ezid.get_journal_metadata(article)
+            ezid_metadata['now'] = now
+            yield article.pk, ezid_metadata
@@ -0,0 +1,149 @@
+"""
+This module contains the EZID plugin's in-process timers and counters
+
+Every phase of a deposit (settings lookup, metadata gathering, template rendering, URL
+validation, the HTTP round trip and response parsing) is timed, and every EZID request is
+counted by action and outcome. Recording is a lock and a few dict updates, so it stays on.
+
+Metrics are per process: the web process exposes its own through the ezid_metrics view,
+bulk management commands print theirs when they finish.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+PHASE_SETTINGS = 'settings'
+PHASE_METADATA = 'metadata'
+PHASE_RENDER = 'render'
+PHASE_VALIDATE = 'validate'
+PHASE_HTTP = 'http'
+PHASE_PREFLIGHT = 'preflight'
+PHASE_PARSE = 'parse'
+PHASES = (PHASE_SETTINGS, PHASE_METADATA, PHASE_RENDER, PHASE_VALIDATE, PHASE_PREFLIGHT, PHASE_HTTP, PHASE_PARSE)
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_EZID_ERROR = 'ezid_error'
+OUTCOME_TRANSPORT_ERROR = 'transport_error'
+
+logger = logging.getLogger(__name__)
+
+# HTTP round trips kept for recent latency percentiles
+RECENT_SAMPLES = 1000
+
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_recent_http = deque(maxlen=RECENT_SAMPLES)
+
+def record(phase, seconds):
+    ''' adds one timing to a phase '''
+    with _lock:
+        timer = _timers.get(phase)
+        if timer is None:
+            _timers[phase] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+        if phase == PHASE_HTTP:
+            _recent_http.append(seconds)
+
+@contextmanager
+def timer(phase):
+    ''' times the body of a with block as one call of the given phase, whether or not it raises '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+def count(action, outcome):
+    ''' counts one EZID request by action (mint, create, update) and outcome '''
+    key = (action, outcome)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + 1
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _recent_http.clear()
+
+def snapshot():
+    '''
+    returns a copy of the metrics:
+    {'timers': {phase: (count, total seconds, max seconds)}, 'counters': {(action, outcome): count}}
+    '''
+    with _lock:
+        return {'timers': {phase: tuple(timer) for phase, timer in _timers.items()},
+                'counters': dict(_counters)}
+
+def recent_http_latency(fraction=0.5):
+    ''' returns the given percentile of the most recent HTTP round trips in seconds, or None '''
+    with _lock:
+        samples = sorted(_recent_http)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def prometheus_text():
+    ''' returns the metrics in the Prometheus text exposition format '''
+    metrics = snapshot()
+    lines = ['# HELP ezid_phase_seconds Time spent in each phase of EZID deposits.',
+             '# TYPE ezid_phase_seconds summary']
+    for phase, (calls, total, _) in sorted(metrics['timers'].items()):
+        lines.append('ezid_phase_seconds_count{{phase="{}"}} {}'.format(phase, calls))
+        lines.append('ezid_phase_seconds_sum{{phase="{}"}} {:.6f}'.format(phase, total))
+    lines += ['# HELP ezid_phase_seconds_max Slowest call in each phase of EZID deposits.',
+              '# TYPE ezid_phase_seconds_max gauge']
+    for phase, (_, _, slowest) in sorted(metrics['timers'].items()):
+        lines.append('ezid_phase_seconds_max{{phase="{}"}} {:.6f}'.format(phase, slowest))
+    lines += ['# HELP ezid_requests_total EZID requests by action and outcome.',
+              '# TYPE ezid_requests_total counter']
+    for (action, outcome), total in sorted(metrics['counters'].items()):
+        lines.append('ezid_requests_total{{action="{}",outcome="{}"}} {}'.format(action, outcome, total))
+    return '\n'.join(lines) + '\n'
+
+def summary_lines():
+    ''' returns human readable lines, one per phase and one per action, in pipeline order '''
+    metrics = snapshot()
+    lines = []
+    for phase in PHASES:
+        if phase in metrics['timers']:
+            calls, total, slowest = metrics['timers'][phase]
+            lines.append('{:<9} {:>7} calls {:>9.2f}s total {:>9.1f}ms avg {:>9.1f}ms max'.format(
+                phase, calls, total, total / calls * 1000, slowest * 1000))
+
+    outcomes = {}
+    for (action, outcome), total in metrics['counters'].items():
+        outcomes.setdefault(action, {})[outcome] = total
+    for action, totals in sorted(outcomes.items()):
+        lines.append('{:<9} {}'.format(action, ', '.join(
+            '{} {}'.format(totals.get(outcome, 0), outcome) for outcome in (OUTCOME_SUCCESS, OUTCOME_EZID_ERROR, OUTCOME_TRANSPORT_ERROR))))
+    return lines
+
+def log_summary(log=logger):
+    ''' writes one key=value line per phase and per action/outcome, for log based collection '''
+    metrics = snapshot()
+    for phase, (calls, total, slowest) in metrics['timers'].items():
+        log.info('ezid_metrics phase={} count={} total_ms={:.1f} max_ms={:.1f}'.format(phase, calls, total * 1000, slowest * 1000))
+    for (action, outcome), total in metrics['counters'].items():
+        log.info('ezid_metrics action={} outcome={} count={}'.format(action, outcome, total))
+
+def write_summary(write):
+    ''' writes the summary with the given function (a management command's stdout.write) and logs it '''
+    lines = summary_lines()
+    if not lines:
+        return
+    write('EZID timings and outcomes:')
+    for line in lines:
+        write('  ' + line)
+    log_summary()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repository', '0030_merge_20220613_1628'),
+        ('ezid', '0004_ezidpayloadfingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repoezidsettings',
+            name='ezid_doi_pool_size',
+            field=models.PositiveIntegerField(default=0, help_text='Number of reserved DOIs to keep ready for publication, 0 disables the pool.'),
+        ),
+        migrations.AddField(
+            model_name='repoezidsettings',
+            name='ezid_doi_pool_low_water',
+            field=models.PositiveIntegerField(default=0, help_text='The pool is refilled when fewer reserved DOIs than this are left.'),
+        ),
+        migrations.AlterField(
+            model_name='ezidjob',
+            name='action',
+            field=models.CharField(choices=[('mint', 'Mint DOI'), ('update', 'Update DOI metadata'), ('publish', 'Make reserved DOI public')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='EZIDReservedDOI',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doi', models.CharField(max_length=255, unique=True)),
+                ('date_reserved', models.DateTimeField(auto_now_add=True)),
+                ('date_claimed', models.DateTimeField(blank=True, null=True)),
+                ('ezid_settings', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reserved_dois', to='ezid.RepoEZIDSettings')),
+                ('preprint', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='repository.Preprint')),
+            ],
+        ),
+    ]
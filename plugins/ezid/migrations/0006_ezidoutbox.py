@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repository', '0030_merge_20220613_1628'),
+        ('submission', '__first__'),
+        ('ezid', '0005_ezid_doi_pool'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EZIDOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('mint', 'Mint DOI'), ('update', 'Update DOI metadata'), ('publish', 'Make reserved DOI public'), ('journal_create', 'Create journal article DOI'), ('journal_update', 'Update journal article DOI metadata')], max_length=20)),
+                ('error', models.TextField(blank=True)),
+                ('replays', models.PositiveIntegerField(default=0)),
+                ('resolved', models.BooleanField(db_index=True, default=False)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('date_replayed', models.DateTimeField(blank=True, null=True)),
+                ('article', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='submission.Article')),
+                ('preprint', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='repository.Preprint')),
+            ],
+        ),
+    ]
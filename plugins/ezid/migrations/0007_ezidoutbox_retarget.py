@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 16:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0006_ezidoutbox'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ezidoutbox',
+            name='action',
+            field=models.CharField(choices=[('mint', 'Mint DOI'), ('update', 'Update DOI metadata'), ('publish', 'Make reserved DOI public'), ('retarget', 'Update DOI target URL'), ('journal_create', 'Create journal article DOI'), ('journal_update', 'Update journal article DOI metadata')], max_length=20),
+        ),
+    ]
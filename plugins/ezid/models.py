@@ -1,6 +1,7 @@
 from django.db import models
+from django.utils import timezone
 
-from repository.models import Repository
+from repository.models import Repository, Preprint
 
 class RepoEZIDSettings(models.Model):
     repo = models.OneToOneField(Repository)
@@ -9,6 +10,85 @@ class RepoEZIDSettings(models.Model):
     ezid_username = models.CharField(max_length=200)
     ezid_password = models.CharField(max_length=200)
     ezid_endpoint_url = models.URLField(max_length=300)
+    ezid_doi_pool_size = models.PositiveIntegerField(default=0, help_text="Number of reserved DOIs to keep ready for publication, 0 disables the pool.")
+    ezid_doi_pool_low_water = models.PositiveIntegerField(default=0, help_text="The pool is refilled when fewer reserved DOIs than this are left.")
 
     def __str__(self):
         return "EZID settings: {}".format(self.repo)
+
+class EZIDJob(models.Model):
+    ACTION_MINT = 'mint'
+    ACTION_UPDATE = 'update'
+    ACTION_PUBLISH = 'publish'
+    ACTION_CHOICES = (
+        (ACTION_MINT, 'Mint DOI'),
+        (ACTION_UPDATE, 'Update DOI metadata'),
+        (ACTION_PUBLISH, 'Make reserved DOI public'),
+    )
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_DEAD = 'dead'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_DEAD, 'Dead'),
+    )
+
+    preprint = models.ForeignKey(Preprint, on_delete=models.CASCADE)
+    action = models.CharField(max_length=20, choices=ACTION_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "EZID {} job for preprint {}: {}".format(self.action, self.preprint_id, self.status)
+
+class EZIDPayloadFingerprint(models.Model):
+    doi = models.CharField(max_length=255, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    date_deposited = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "EZID payload fingerprint: {}".format(self.doi)
+
+class EZIDReservedDOI(models.Model):
+    ezid_settings = models.ForeignKey(RepoEZIDSettings, on_delete=models.CASCADE, related_name='reserved_dois')
+    doi = models.CharField(max_length=255, unique=True)
+    preprint = models.OneToOneField(Preprint, on_delete=models.SET_NULL, blank=True, null=True)
+    date_reserved = models.DateTimeField(auto_now_add=True)
+    date_claimed = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return "Reserved DOI: {}".format(self.doi)
+
+class EZIDOutbox(models.Model):
+    ACTION_MINT = EZIDJob.ACTION_MINT
+    ACTION_UPDATE = EZIDJob.ACTION_UPDATE
+    ACTION_PUBLISH = EZIDJob.ACTION_PUBLISH
+    ACTION_RETARGET = 'retarget'
+    ACTION_JOURNAL_CREATE = 'journal_create'
+    ACTION_JOURNAL_UPDATE = 'journal_update'
+    ACTION_CHOICES = EZIDJob.ACTION_CHOICES + (
+        (ACTION_RETARGET, 'Update DOI target URL'),
+        (ACTION_JOURNAL_CREATE, 'Create journal article DOI'),
+        (ACTION_JOURNAL_UPDATE, 'Update journal article DOI metadata'),
+    )
+
+    preprint = models.ForeignKey(Preprint, on_delete=models.CASCADE, blank=True, null=True)
+    article = models.ForeignKey('submission.Article', on_delete=models.CASCADE, blank=True, null=True)
+    action = models.CharField(max_length=20, choices=ACTION_CHOICES)
+    error = models.TextField(blank=True)
+    replays = models.PositiveIntegerField(default=0)
+    resolved = models.BooleanField(default=False, db_index=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_updated = models.DateTimeField(auto_now=True)
+    date_replayed = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return "EZID {} failure for {}".format(self.action, self.preprint or self.article)
@@ -63,3 +63,7 @@ def hook_registry():
     event_logic.Events.register_for_event(event_logic.Events.ON_PREPRINT_PUBLICATION,
                                           logic.preprint_publication)
 
+    # not every Janeway version fires a version update event, the post_save signals in logic cover the rest
+    version_update = getattr(event_logic.Events, 'ON_PREPRINT_VERSION_UPDATE', None)
+    if version_update is not None:
+        event_logic.Events.register_for_event(version_update, logic.preprint_version_update)
@@ -0,0 +1,100 @@
+"""
+This module contains the optional offline check of rendered Crossref records against the Crossref XSDs
+
+Set EZID_PREFLIGHT = True to check every payload before it is sent, so invalid records fail
+without an EZID round trip. The schemas are read from the plugin's schemas directory, or from
+EZID_SCHEMA_DIR, and compiled once per thread. Needs lxml (pip install lxml); when lxml or a
+schema is missing the check raises ImproperlyConfigured rather than letting payloads through
+unchecked. `manage.py fetch_crossref_schemas` downloads the schemas.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# the Crossref schema each template is written against
+SCHEMA_FILES = {
+    'ezid/posted_content.xml': 'crossref4.4.0.xsd',
+    'ezid/journal_content.xml': 'crossref5.3.1.xsd',
+}
+DEFAULT_SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas')
+
+FETCH_HINT = 'run `python src/manage.py fetch_crossref_schemas` to download the Crossref schemas'
+
+# a compiled schema keeps the error log of its last validation, so each thread validates with its own copy
+_local = threading.local()
+
+class PreflightError(Exception):
+    ''' a rendered record does not validate against its Crossref schema '''
+
+    def __init__(self, template, errors):
+        super().__init__('{} does not validate: {}'.format(template, '; '.join(errors[:5])))
+        self.template = template
+        self.errors = errors
+
+    def as_result(self):
+        ''' returns the error in the "error: ..." form of EZID responses '''
+        return 'error: preflight: {}'.format(self)
+
+def is_enabled():
+    return getattr(settings, 'EZID_PREFLIGHT', False)
+
+def get_schema_dir():
+    return getattr(settings, 'EZID_SCHEMA_DIR', None) or DEFAULT_SCHEMA_DIR
+
+def get_schema(filename):
+    ''' returns the calling thread's compiled schema, raises ImproperlyConfigured if it cannot be loaded '''
+    schemas = getattr(_local, 'schemas', None)
+    if schemas is None:
+        schemas = _local.schemas = {}
+    if filename not in schemas:
+        schemas[filename] = load_schema(filename)
+    return schemas[filename]
+
+def load_schema(filename):
+    try:
+        from lxml import etree
+    except ImportError:
+        raise ImproperlyConfigured('EZID preflight needs lxml, install it with `pip install lxml`.')
+
+    path = os.path.join(get_schema_dir(), filename)
+    if not os.path.exists(path):
+        raise ImproperlyConfigured('EZID preflight: {} not found, {}.'.format(path, FETCH_HINT))
+    try:
+        # imported and included schemas are resolved relative to the file
+        return etree.XMLSchema(etree.parse(path))
+    except (OSError, etree.XMLSyntaxError, etree.XMLSchemaParseError) as error:
+        # most often a schema it imports is missing
+        raise ImproperlyConfigured('EZID preflight: cannot load {} ({}), {}.'.format(path, error, FETCH_HINT))
+
+def validate_crossref(template, crossref_xml):
+    '''
+    returns the schema errors of a rendered crossref record, an empty list if it is valid or its
+    template has no schema; raises ImproperlyConfigured if the schema cannot be loaded
+    '''
+    filename = SCHEMA_FILES.get(template)
+    if filename is None:
+        return []
+    schema = get_schema(filename)
+
+    from lxml import etree
+    try:
+        document = etree.fromstring(crossref_xml.encode('UTF-8'))
+    except etree.XMLSyntaxError as error:
+        return [str(error)]
+
+    if schema.validate(document):
+        return []
+    return ['line {}: {}'.format(error.line, error.message) for error in schema.error_log]
+
+def check(template, crossref_xml):
+    ''' raises PreflightError if the rendered record does not validate '''
+    errors = validate_crossref(template, crossref_xml)
+    if errors:
+        raise PreflightError(template, errors)
@@ -0,0 +1,99 @@
+"""
+This module contains the registry of EZID configurations and clients, per repository and per journal
+
+A repository's RepoEZIDSettings row is read the first time one of its DOIs is deposited, and the
+resulting config is reused by every later hook call, queue job and bulk command in the process.
+Saving or deleting the row drops the entry in the process that made the change; other processes
+reload it once it is EZID_REGISTRY_TIMEOUT seconds old. Journals share the EZID_* credentials from
+the Django settings, which are read when a config is built, not at import time.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import client
+from .models import RepoEZIDSettings
+
+DEFAULT_REGISTRY_TIMEOUT = 5 * 60
+
+# repository pk -> (ezid_config or None when it has no EZID settings, time loaded)
+_repositories = {}
+_lock = threading.Lock()
+
+def get_timeout():
+    return getattr(settings, 'EZID_REGISTRY_TIMEOUT', DEFAULT_REGISTRY_TIMEOUT)
+
+def get_client(username, password, endpoint_url):
+    ''' returns the shared, pooled EZID client for the given endpoint and credentials '''
+    return client.get_client(username, password, endpoint_url,
+                             pool_size=getattr(settings, 'EZID_POOL_SIZE', client.DEFAULT_POOL_SIZE),
+                             timeout=getattr(settings, 'EZID_TIMEOUT', client.DEFAULT_TIMEOUT),
+                             retries=getattr(settings, 'EZID_RETRIES', client.DEFAULT_RETRIES),
+                             retry_backoff=getattr(settings, 'EZID_RETRY_BACKOFF', client.DEFAULT_RETRY_BACKOFF),
+                             breaker_threshold=getattr(settings, 'EZID_BREAKER_THRESHOLD', client.DEFAULT_BREAKER_THRESHOLD),
+                             breaker_reset=getattr(settings, 'EZID_BREAKER_RESET', client.DEFAULT_BREAKER_RESET))
+
+def get_config_client(ezid_config):
+    ''' returns the shared client for an ezid_config '''
+    return get_client(ezid_config['username'], ezid_config['password'], ezid_config['endpoint_url'])
+
+def get_repository_config(repo):
+    '''
+    returns the ezid_config dictionary for the given repository, querying RepoEZIDSettings only when
+    the repository is not registered yet or its entry has expired
+
+    raises RepoEZIDSettings.DoesNotExist for a repository without EZID settings
+    '''
+    ezid_config = find_repository_config(repo)
+    if ezid_config is None:
+        raise RepoEZIDSettings.DoesNotExist('{} has no EZID settings'.format(repo))
+    return ezid_config
+
+def find_repository_config(repo):
+    ''' returns the ezid_config dictionary for the given repository, or None if it has no EZID settings '''
+    with _lock:
+        entry = _repositories.get(repo.pk)
+    if entry is None or time.monotonic() - entry[1] >= get_timeout():
+        ezid_settings = RepoEZIDSettings.objects.filter(repo=repo).first()
+        ezid_config = None
+        if ezid_settings is not None:
+            ezid_config = {'shoulder': ezid_settings.ezid_shoulder,
+                           'username': ezid_settings.ezid_username,
+                           'password': ezid_settings.ezid_password,
+                           'endpoint_url': ezid_settings.ezid_endpoint_url,
+                           'owner': ezid_settings.ezid_owner}
+        # repositories without settings are remembered too, saving their settings drops the entry
+        entry = (ezid_config, time.monotonic())
+        with _lock:
+            _repositories[repo.pk] = entry
+    return dict(entry[0]) if entry[0] is not None else None
+
+def get_journal_config(owner):
+    ''' returns the ezid_config dictionary for journal deposits billed to owner, the Crossref registrant '''
+    return {'username': settings.EZID_USERNAME,
+            'password': settings.EZID_PASSWORD,
+            'endpoint_url': settings.EZID_ENDPOINT_URL,
+            'owner': owner}
+
+def forget_repository(repo_pk):
+    ''' drops a repository's entry, it is loaded again on next use '''
+    with _lock:
+        _repositories.pop(repo_pk, None)
+
+def clear():
+    with _lock:
+        _repositories.clear()
+
+@receiver(post_save, sender=RepoEZIDSettings)
+@receiver(post_delete, sender=RepoEZIDSettings)
+def repo_ezid_settings_changed(sender, instance, **kwargs):
+    ''' drops the cached config when a repository's EZID settings are saved or deleted '''
+    forget_repository(instance.repo_id)
@@ -0,0 +1,167 @@
+"""
+Tests for the EZID plugin, run with: python manage.py test plugins.ezid
+
+The EZID requests are answered by fake_ezid.FakeEZIDServer on a local port, no network access is needed.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+from django.db import connection
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from repository.models import Preprint, PreprintAuthor
+from utils.testing import helpers
+
+from plugins.ezid import client
+from plugins.ezid import logic as ezid
+from plugins.ezid.fake_ezid import FakeEZIDServer, SHOULDER
+
+TEMPLATE = 'ezid/posted_content.xml'
+
+class FakeEZIDClientTests(SimpleTestCase):
+    ''' the pooled client against the fake server, no database needed '''
+
+    def setUp(self):
+        self.server = FakeEZIDServer().start()
+        self.addCleanup(self.server.stop)
+        self.ezid_client = client.EZIDClient(self.server.username, self.server.password, self.server.endpoint_url,
+                                             retry_backoff=0)
+        self.addCleanup(self.ezid_client.close)
+
+    def test_mint_then_get(self):
+        status, reason, body = self.ezid_client.mint(SHOULDER, '_target: https://example.org/1')
+        self.assertEqual(status, 201)
+        identifier = body[len('success: '):]
+        self.assertTrue(identifier.startswith(SHOULDER))
+
+        status, reason, body = self.ezid_client.get(identifier[len('doi:'):])
+        metadata = client.parse_anvl(body.split('\n', 1)[1])
+        self.assertEqual(metadata['_target'], 'https://example.org/1')
+
+    def test_server_errors_are_retried(self):
+        self.server.fail_next(2, status=500)
+        status, reason, body = self.ezid_client.create('10.5072/FK2RETRY', '_target: https://example.org/2')
+        self.assertEqual(status, 201)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_mint_is_not_retried_once_sent(self):
+        self.server.fail_next(1, status=500)
+        with self.assertRaises(client.EZIDServerError):
+            self.ezid_client.mint(SHOULDER, '_target: https://example.org/3')
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.server.identifiers, {})
+
+    def test_client_errors_are_not_retried(self):
+        with self.assertRaises(client.EZIDClientError):
+            self.ezid_client.update('10.5072/FK2MISSING', '_target: https://example.org/4')
+        self.assertEqual(self.server.requests, 1)
+
+    def test_breaker_counts_requests_not_attempts(self):
+        breaker = self.ezid_client.breaker
+        self.server.fail_next(self.ezid_client.retries + 1, status=500)
+        with self.assertRaises(client.EZIDServerError):
+            self.ezid_client.create('10.5072/FK2BREAKER', '_target: https://example.org/5')
+        self.assertEqual(breaker.failures, 1)
+        self.assertFalse(breaker.is_open)
+
+    def test_half_open_breaker_lets_one_trial_through(self):
+        breaker = client.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.before_request()
+        with self.assertRaises(client.EZIDCircuitOpenError):
+            breaker.before_request()
+        breaker.record_success()
+        breaker.before_request()
+
+class PreprintDOITests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.press = helpers.create_press()
+        cls.owner = helpers.create_user('ezid_owner@example.org')
+        cls.owner.first_name, cls.owner.last_name = 'Ada', 'Lovelace'
+        cls.owner.save()
+        cls.repository, cls.subject = helpers.create_repository(cls.press, [cls.owner], [])
+        cls.coauthors = [helpers.create_user('ezid_author_{}@example.org'.format(i)) for i in range(3)]
+
+    def create_preprint(self, coauthors=0):
+        preprint = helpers.create_preprint(self.repository, self.owner, self.subject)
+        for order, account in enumerate(self.coauthors[:coauthors], start=2):
+            PreprintAuthor.objects.create(preprint=preprint, account=account, order=order)
+        preprint.date_accepted = preprint.date_published = timezone.now()
+        preprint.save()
+        return preprint
+
+    def setUp(self):
+        self.server = FakeEZIDServer().start()
+        self.addCleanup(self.server.stop)
+        self.ezid_config = self.server.ezid_config()
+
+    def count_batch_queries(self, preprints):
+        ''' returns the number of queries it takes to gather the metadata of the preprints, in one batch '''
+        queryset = Preprint.objects.filter(pk__in=[preprint.pk for preprint in preprints])
+        with CaptureQueriesContext(connection) as context:
+            batch = next(ezid.preprint_metadata_batches(queryset, batch_size=len(preprints)))
+        self.assertEqual(len(batch), len(preprints))
+        self.assertTrue(all(ezid_metadata is not None for _, ezid_metadata in batch))
+        return len(context.captured_queries)
+
+    def test_metadata_batch_queries_do_not_grow_with_the_batch(self):
+        small = self.count_batch_queries([self.create_preprint()])
+        large = self.count_batch_queries([self.create_preprint(coauthors=n % 4) for n in range(8)])
+        self.assertEqual(small, large)
+
+    def test_prefetched_metadata_needs_no_queries(self):
+        preprints = [self.create_preprint(coauthors=n % 4) for n in range(4)]
+        preprints = list(Preprint.objects.filter(pk__in=[preprint.pk for preprint in preprints]).order_by('pk'))
+        ezid.prefetch_preprint_metadata(preprints)
+        with self.assertNumQueries(0):
+            contributors = [ezid.get_preprint_metadata(preprint)['contributors'] for preprint in preprints]
+        self.assertEqual([len(authors) for authors in contributors], [1, 2, 3, 4])
+
+    def test_mint(self):
+        preprint = self.create_preprint(coauthors=1)
+        ezid_metadata = ezid.get_preprint_metadata(preprint)
+
+        ezid_result = ezid.mint_doi_via_ezid(self.ezid_config, ezid_metadata, TEMPLATE)
+
+        self.assertTrue(ezid_result.startswith('success: ' + SHOULDER), ezid_result)
+        identifier = ezid_result[len('success: '):]
+        record = self.server.identifiers[identifier]
+        self.assertEqual(record['_target'], ezid_metadata['target_url'])
+        self.assertEqual(record['_owner'], self.ezid_config['owner'])
+        self.assertIn('<surname>Lovelace</surname>', record['crossref'])
+
+    def test_unchanged_update_is_skipped(self):
+        preprint = self.create_preprint()
+        ezid_result = ezid.mint_doi_via_ezid(self.ezid_config, ezid.get_preprint_metadata(preprint), TEMPLATE)
+        doi = ezid.parse_doi(ezid_result)
+
+        def update():
+            ezid_metadata = ezid.get_preprint_metadata(preprint)
+            ezid_metadata['update_id'] = doi
+            return ezid.update_doi_if_changed(self.ezid_config, ezid_metadata, TEMPLATE)
+
+        outcome, ezid_result = update()
+        self.assertEqual(outcome, ezid.UPDATE_SENT)
+        self.assertTrue(ezid_result.startswith('success:'), ezid_result)
+
+        requests = self.server.requests
+        self.assertEqual(update(), (ezid.UPDATE_SKIPPED, None))
+        self.assertEqual(self.server.requests, requests)
+
+        preprint.title = 'A new title'
+        preprint.save()
+        outcome, ezid_result = update()
+        self.assertEqual(outcome, ezid.UPDATE_CHANGED)
+        self.assertIn('A new title', self.server.identifiers['doi:' + doi]['crossref'])
+
+    def test_failed_mint_is_reported(self):
+        self.server.fail_next(1, status=500)
+        ezid_result = ezid.mint_doi_via_ezid(self.ezid_config, ezid.get_preprint_metadata(self.create_preprint()), TEMPLATE)
+        self.assertTrue(ezid_result.startswith('error:'), ezid_result)
+        self.assertEqual(self.server.identifiers, {})
@@ -5,4 +5,5 @@ from plugins.ezid import views
 
 urlpatterns = [
     url(r'^manager/$', views.ezid_manager, name='ezid_manager'),
+    url(r'^metrics/$', views.ezid_metrics, name='ezid_metrics'),
 ]
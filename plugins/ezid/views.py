@@ -1,6 +1,8 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
 from django.shortcuts import render
 
-from plugins.ezid import forms
+from plugins.ezid import forms, logic, metrics
 
 
 def ezid_manager(request):
@@ -9,6 +11,15 @@ def ezid_manager(request):
     template = 'ezid/manager.html'
     context = {
         'form': form,
+        'queue': logic.ezid_queue_stats(),
+        'coverage': logic.get_doi_coverage(),
+        'latency': logic.get_http_latency(),
     }
 
     return render(request, template, context)
+
+
+@staff_member_required
+def ezid_metrics(request):
+    """ this process's EZID timers and counters, in the Prometheus text format """
+    return HttpResponse(metrics.prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')